@@ -173,6 +173,13 @@ class Baseline(LightningModule):
                 else:
                     self.val_set_transform = ImageNetDistortVal(self.hparams)
 
+            #Optionally distort the collated batch in the training step instead of in the DataLoader workers
+            if hasattr(self.hparams, 'batch_distortion') and self.hparams.batch_distortion:
+                self.batch_distortion = BatchDistortion(self.hparams)
+                self.train_set_transform = ImageNetCropTrain(self.hparams)
+            else:
+                self.batch_distortion = None
+
         #(2) Grab the correct baseline pre-trained model
         if self.hparams.encoder == 'resnet':
             self.encoder = RESNET_finetune(self.hparams)
@@ -211,11 +218,7 @@ class Baseline(LightningModule):
     #DATALOADERS
     def train_dataloader(self):
         if self.hparams.dataset == "ImageNet100":
-            train_dataset = ImageNet100(
-                root=self.hparams.dataset_dir,
-                split = 'train',
-                transform = self.train_set_transform
-            )
+            train_dataset = imagenet100_dataset(self.hparams, split='train', transform=self.train_set_transform)
 
         train_dataloader = DataLoader(train_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.workers,\
                                         pin_memory=True, shuffle=True)
@@ -224,11 +227,7 @@ class Baseline(LightningModule):
 
     def val_dataloader(self):
         if self.hparams.dataset == "ImageNet100":
-            val_dataset = ImageNet100(
-                root=self.hparams.dataset_dir,
-                split = 'val',
-                transform = self.val_set_transform
-            )
+            val_dataset = imagenet100_dataset(self.hparams, split='val', transform=self.val_set_transform)
 
             self.N_val = 5000
 
@@ -239,11 +238,7 @@ class Baseline(LightningModule):
 
     def test_dataloader(self):
         if self.hparams.dataset == "ImageNet100":
-            test_dataset = ImageNet100(
-                root=self.hparams.dataset_dir,
-                split = 'val',
-                transform = self.val_set_transform
-            )
+            test_dataset = imagenet100_dataset(self.hparams, split='val', transform=self.val_set_transform)
 
         test_dataloader = DataLoader(test_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.workers,\
                                         pin_memory=True, shuffle=False)
@@ -251,6 +246,10 @@ class Baseline(LightningModule):
         return test_dataloader
     
     #TRAINING
+    def on_train_epoch_start(self):
+        # Keyed training sets (with distortion_seed) get new keys every epoch.
+        set_epoch(self.trainer.train_dataloader, self.current_epoch)
+
     def training_step(self, batch, batch_idx):
         """
         Given a batch of images, train the model for one step.
@@ -258,6 +257,7 @@ class Baseline(LightningModule):
 
         Inputs:
             batch - the images to train on, shape [batch_size, num_channels, height, width]
+                    (cropped but not yet distorted or normalized if batch_distortion is set)
             batch_idx - the index of the current batch
         
         Returns:
@@ -265,6 +265,9 @@ class Baseline(LightningModule):
         """
         x, y = batch
 
+        if self.batch_distortion is not None:
+            x = self.batch_distortion(x)
+
         if batch_idx == 0 and self.current_epoch == 0:
             self.logger.experiment.add_image('Train_Sample', img_grid(x), self.current_epoch)
 
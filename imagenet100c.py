@@ -46,13 +46,14 @@ class ImageNet100CTest(LightningDataModule):
             self.val_set_transform = ImageNetDistortVal(self.hparams)
 
     def setup(self, stage=None):
-        self.val_data = ImageNet100C(
+        #the transform is attached by eval_dataset, which can read cached center crops and key the distortions
+        self.val_data = eval_dataset(ImageNet100C(
             root=self.hparams.dataset_dir,
             distortion=self.distortion,
             sub_distortion=self.sub_distortion,
             level = self.level,
-            transform=self.val_set_transform
-        )
+            loader=eval_image_loader(self.hparams)
+        ), self.val_set_transform, self.hparams)
 
     def test_dataloader(self):
         return DataLoader(self.val_data, batch_size=512, num_workers=self.hparams.workers, worker_init_fn=(lambda wid: np.random.seed(int(torch.rand(1)[0]*1e6) + wid)), pin_memory=True, shuffle=False)
@@ -74,6 +75,8 @@ def grab_config():
 def noise_level_eval():
     args = grab_config()
     args.gpus = 1 # Force evaluation in a single gpu.
+    # Every corrupted set is only evaluated once per run, and caching the crops of all 95 takes about 71 GB on disk.
+    args.crop_cache = hasattr(args, 'corruption_crop_cache') and args.corruption_crop_cache
 
     seed_everything(42)
 
@@ -14,6 +14,7 @@ import torchvision
 import torchvision.models as models
 
 from utils import *
+from losses import nt_xent_loss, clip_loss, gather_embeddings
 
 from pytorch_lightning import Trainer, LightningModule, LightningDataModule, seed_everything
 from pytorch_lightning.loggers import TensorBoardLogger
@@ -27,18 +28,32 @@ class ContrastiveUnsupervisedDataset(torch.utils.data.Dataset):
     This class takes a dataset and creates a contrastive version of that dataset.
     Each item of the dataset is a tuple of a clean image and a noisy image (two
     separate transformations.)
+    With compact=True, transform_contrastive only crops the image to uint8 (ImageNetCropTrain/ImageNetCropVal) and each item
+    is the crop and its key (seed, index, epoch) instead; BatchDistortion.paired_views makes both images from them on the device.
+    With key_seed, transform_contrastive gets the key (key_seed, index, epoch) of every sample, as with KeyedDataset.
+    Set the epoch attribute at the start of every epoch.
     """
-    def __init__(self, clean_dataset, transform_contrastive=None, return_label=False):
+    def __init__(self, clean_dataset, transform_contrastive=None, return_label=False, compact=False, seed=0, key_seed=None):
         self.base = clean_dataset
         self.transform_contrastive = transform_contrastive
         self.return_label = return_label
+        self.compact = compact
+        self.seed = seed
+        self.key_seed = key_seed
+        self.epoch = 0
 
     def __len__(self):
         return len(self.base)
 
     def __getitem__(self, idx):
         image_orig, label = self.base[idx]
-        image_clean, image_noisy = self.transform_contrastive(image_orig) if self.transform_contrastive is not None else (image_orig, image_orig)
+        if self.compact:
+            #the key takes the place of the noisy image
+            image_clean, image_noisy = self.transform_contrastive(image_orig), torch.tensor([self.seed, idx, self.epoch])
+        elif self.key_seed is not None:
+            image_clean, image_noisy = self.transform_contrastive(image_orig, key=(self.key_seed, idx, self.epoch))
+        else:
+            image_clean, image_noisy = self.transform_contrastive(image_orig) if self.transform_contrastive is not None else (image_orig, image_orig)
         if self.return_label:
             return image_clean, image_noisy, label
         else:
@@ -69,20 +84,26 @@ class ImageNetCLIPDataset(LightningDataModule):
             else:
                 self.val_set_transform = ImageNetDistortValContrastive(self.hparams)
 
+        #with compact_pairs, the workers only send uint8 crops and their keys, and the model makes both images of each pair
+        self.compact_pairs = hasattr(self.hparams, 'compact_pairs') and self.hparams.compact_pairs
+        if self.compact_pairs:
+            self.train_set_transform = ImageNetCropTrain(self.hparams, uint8=True)
+            self.val_set_transform = ImageNetCropVal(self.hparams, uint8=True)
+
+        #with teacher_table, the training samples are fixed uint8 crops and the precomputed teacher embeddings of those crops
+        self.teacher_table = self.hparams.teacher_table if hasattr(self.hparams, 'teacher_table') else None
+
     def setup(self, stage=None):
-        train_data = ImageNet100(
-        	root=self.hparams.dataset_dir,
-            split="train",
-            transform=None
-        )
-        val_data = ImageNet100(
-            root=self.hparams.dataset_dir,
-            split="val",
-            transform=None
-        )
-
-        self.train_contrastive = ContrastiveUnsupervisedDataset(train_data, transform_contrastive=self.train_set_transform)
-        self.val_contrastive = ContrastiveUnsupervisedDataset(val_data, transform_contrastive=self.val_set_transform)
+        # Same images as precompute_teacher.py, so that the fixed crops match the ones of the teacher table.
+        train_data = imagenet100_dataset(self.hparams, split="train", transform=None)
+        val_data = imagenet100_dataset(self.hparams, split="val", transform=None)
+
+        if self.teacher_table:
+            self.train_contrastive = TeacherEmbeddingDataset(train_data, self.teacher_table, seed=teacher_seed(self.hparams), return_label=False)
+        else:
+            self.train_contrastive = ContrastiveUnsupervisedDataset(train_data, transform_contrastive=self.train_set_transform, compact=self.compact_pairs, seed=self.hparams.seed,
+                                                                    key_seed=distortion_seed(self.hparams, self.train_set_transform))
+        self.val_contrastive = ContrastiveUnsupervisedDataset(val_data, transform_contrastive=self.val_set_transform, compact=self.compact_pairs, seed=self.hparams.seed)
 
     def train_dataloader(self):
         return DataLoader(self.train_contrastive, batch_size=self.batch_size, num_workers=self.hparams.workers, pin_memory=True, shuffle=True)
@@ -146,6 +167,16 @@ class NoisyContrastiveBaseline(LightningModule):
         self.student.train()
         self.student.requires_grad_(True)
 
+        #(4) with compact_pairs, the batches hold uint8 crops and their keys, from which the clean and noisy images are made
+        self.compact_pairs = hasattr(self.hparams, 'compact_pairs') and self.hparams.compact_pairs
+        if self.compact_pairs:
+            self.batch_distortion = BatchDistortion(self.hparams)
+
+        #(5) optionally read the clean embeddings from a table made by precompute_teacher.py instead of running the teacher in training
+        self.teacher_table = self.hparams.teacher_table if hasattr(self.hparams, 'teacher_table') else None
+        if self.teacher_table:
+            self.batch_distortion = BatchDistortion(self.hparams)
+
     def criterion(self, input1, input2, reduction='mean'):
         """
         Args:
@@ -155,39 +186,14 @@ class NoisyContrastiveBaseline(LightningModule):
         """
         bsz = input1.shape[0]
 
-        #Use the simclr style InfoNCE
+        #Use the simclr style InfoNCE, optionally computed a chunk of rows at a time
         if self.hparams.loss_type == 'simclr':
-            # Create similarity matrix between embeddings.
-            full_tensor = torch.cat([input1.unsqueeze(1),input2.unsqueeze(1)], dim=1).view(2*bsz, 1, -1)
-            tensor1 = full_tensor.expand(2*bsz,2*bsz,-1)
-            tensor2 = full_tensor.permute(1,0,2).expand(2*bsz,2*bsz,-1)
-            sim_mat = torch.nn.CosineSimilarity(dim=-1)(tensor1,tensor2)
-
-            # Calculate logits used for the contrastive loss.
-            exp_sim_mat = torch.exp(sim_mat/self.hparams.loss_tau)
-            mask = torch.ones_like(exp_sim_mat) - torch.eye(2*bsz).type_as(exp_sim_mat)
-            logmat = -torch.log(exp_sim_mat)+torch.log(torch.sum(mask*exp_sim_mat, 1))
-
-            #Grab the two off-diagonal similarities
-            part1 = torch.sum(torch.diag(logmat, diagonal=1)[np.arange(0,2*bsz,2)])
-            part2 = torch.sum(torch.diag(logmat, diagonal=-1)[np.arange(0,2*bsz,2)])
-
-            #Take the mean of the two off-diagonals
-            loss = (part1 + part2)/2
+            chunk_size = self.hparams.loss_chunk_size if hasattr(self.hparams, 'loss_chunk_size') else None
+            loss = nt_xent_loss(input1, input2, self.hparams.loss_tau, chunk_size=chunk_size)
 
         #Use the CLIP-style InfoNCE
         elif self.hparams.loss_type == 'clip':
-            # Create similarity matrix between embeddings.
-            tensor1 = input1 / input1.norm(dim=-1, keepdim=True)
-            tensor2 = input2 / input2.norm(dim=-1, keepdim=True)
-            sim_mat = (1/self.hparams.loss_tau)*tensor1 @ tensor2.t()
-
-            #Calculate the cross entropy between the similarities of the positive pairs, counted two ways
-            part1 = F.cross_entropy(sim_mat, torch.LongTensor(np.arange(bsz)).type_as(input1))
-            part2 = F.cross_entropy(sim_mat.t(), torch.LongTensor(np.arange(bsz)).type_as(input1))
-
-            #Take the mean of the two off-diagonals
-            loss = (part1+part2)/2
+            loss = clip_loss(input1, input2, self.hparams.loss_tau)
 
         #Take the simple MSE between the clean and noisy embeddings
         elif self.hparams.loss_type == 'mse':
@@ -223,15 +229,29 @@ class NoisyContrastiveBaseline(LightningModule):
         return self.student(image)
 
     # Training methods - here we are concerned with contrastive loss (or MSE) between clean and noisy image embeddings.
+    def on_train_epoch_start(self):
+        # Compact pairs get new keys every epoch.
+        set_epoch(self.trainer.train_dataloader, self.current_epoch)
+
     def training_step(self, train_batch, batch_idx):
         """
         Takes a batch of clean and noisy images and returns their respective embeddings.
+        If compact_pairs is set, takes a batch of uint8 crops and their keys and creates the clean and noisy images here.
+        If teacher_table is set, takes a batch of uint8 crops and the precomputed teacher embeddings of the same crops.
 
         Returns:
             embed_clean: T(xi) where T() is the teacher and xi are clean images. Shape [N, embed_dim]
             embed_noisy: S(yi) where S() is the student and yi are noisy images. Shape [N, embed_dim]
         """
-        image_clean, image_noisy = train_batch
+        if self.teacher_table:
+            images, embed_clean = train_batch
+            embed_noisy = self.encode_noisy_image(self.batch_distortion(images)).flatten(1)
+            return {'embed_clean': embed_clean.type_as(embed_noisy), 'embed_noisy': embed_noisy}
+
+        if self.compact_pairs:
+            image_clean, image_noisy = self.batch_distortion.paired_views(*train_batch)
+        else:
+            image_clean, image_noisy = train_batch
 
         self.teacher.eval()
         with torch.no_grad():
@@ -244,9 +264,10 @@ class NoisyContrastiveBaseline(LightningModule):
     def training_step_end(self, outputs):
         """
         Given all the clean and noisy image embeddings form across GPUs from training_step, gather them onto a single GPU and calculate overall loss.
+        With DDP, the embeddings of all the processes are gathered (with their gradients), so the loss uses the global batch.
         """
-        embed_clean_full = outputs['embed_clean']
-        embed_noisy_full = outputs['embed_noisy']
+        embed_clean_full = gather_embeddings(outputs['embed_clean'])
+        embed_noisy_full = gather_embeddings(outputs['embed_noisy'])
 
         loss = self.criterion(embed_clean_full, embed_noisy_full)
 
@@ -260,7 +281,10 @@ class NoisyContrastiveBaseline(LightningModule):
         Grab the noisy image embeddings: S(yi), where S() is the student and yi = Distort(xi). Done on each GPU.
         Return these to be evaluated in validation step end.
         """
-        image_clean, image_noisy = val_batch
+        if self.compact_pairs:
+            image_clean, image_noisy = self.batch_distortion.paired_views(*val_batch)
+        else:
+            image_clean, image_noisy = val_batch
 
         with torch.no_grad():
             embed_clean = self.teacher(image_clean).flatten(1)
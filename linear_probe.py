@@ -41,6 +41,13 @@ class LinearProbe(LightningModule):
                 else:
                     self.val_set_transform = ImageNetDistortVal(self.hparams)
 
+            #Optionally distort the collated batch in the training step instead of in the DataLoader workers
+            if hasattr(self.hparams, 'batch_distortion') and self.hparams.batch_distortion:
+                self.batch_distortion = BatchDistortion(self.hparams)
+                self.train_set_transform = ImageNetCropTrain(self.hparams)
+            else:
+                self.batch_distortion = None
+
         #This should be initialised as a trained student CLIP network
         saved_student = NoisyCLIP.load_from_checkpoint(self.hparams.checkpoint_path)
 
@@ -91,11 +98,7 @@ class LinearProbe(LightningModule):
 
     def train_dataloader(self):
         if self.hparams.dataset == "ImageNet100":
-            train_dataset = ImageNet100(
-                root=self.hparams.dataset_dir,
-                split = 'train',
-                transform = self.train_set_transform
-            )
+            train_dataset = imagenet100_dataset(self.hparams, split='train', transform=self.train_set_transform)
         N_train = len(train_dataset)
         if self.hparams.use_subset:
             train_dataset = few_shot_dataset(train_dataset, int(np.ceil(N_train*self.hparams.subset_ratio/self.hparams.num_classes)))
@@ -107,11 +110,7 @@ class LinearProbe(LightningModule):
 
     def val_dataloader(self):
         if self.hparams.dataset == "ImageNet100":
-            val_dataset = ImageNet100(
-                root=self.hparams.dataset_dir,
-                split = 'val',
-                transform = self.val_set_transform
-            )
+            val_dataset = imagenet100_dataset(self.hparams, split='val', transform=self.val_set_transform)
 
             self.N_val = 5000
 
@@ -120,9 +119,16 @@ class LinearProbe(LightningModule):
 
         return val_dataloader
 
+    def on_train_epoch_start(self):
+        # Keyed training sets (with distortion_seed) get new keys every epoch.
+        set_epoch(self.trainer.train_dataloader, self.current_epoch)
+
     def training_step(self, batch, batch_idx):
         x, y = batch
 
+        if self.batch_distortion is not None:
+            x = self.batch_distortion(x)
+
         if batch_idx == 0 and self.current_epoch == 0:
             self.logger.experiment.add_image('Train_Sample', img_grid(x), self.current_epoch)
 
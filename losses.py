@@ -0,0 +1,165 @@
+import functools
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+class GatherLayer(torch.autograd.Function):
+    """
+    All-gathers a tensor of the same shape from every process, keeping the gradient: the backward pass sums the gradients
+    of every gathered copy over the processes (with all_reduce) and returns the one of the local tensor.
+    Works with the nccl and gloo backends.
+    """
+    @staticmethod
+    def forward(ctx, x):
+        gathered = [torch.zeros_like(x) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, x.contiguous())
+        return tuple(gathered)
+
+    @staticmethod
+    def backward(ctx, *grads):
+        grads = torch.stack(grads)
+        dist.all_reduce(grads)
+        return grads[dist.get_rank()]
+
+def gather_embeddings(x):
+    """
+    Concatenates the batches of embeddings of every process along the first dimension, in the order of the ranks, with
+    gradients flowing back to the local batch. Batches of different sizes (e.g. the last one) are padded for the all_gather.
+    Returns x unchanged outside of distributed training, e.g. with DataParallel.
+
+    Since every process then computes the same loss over the global batch, and DDP averages the gradients of the
+    processes, the summed gradients of the backward pass give the gradient of the global loss.
+    """
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return x
+
+    #the sizes of the batches of every process
+    size = torch.tensor([x.shape[0]], device=x.device)
+    sizes = [torch.zeros_like(size) for _ in range(dist.get_world_size())]
+    dist.all_gather(sizes, size)
+    sizes = [int(n) for n in sizes]
+
+    padded = torch.cat([x, x.new_zeros((max(sizes) - x.shape[0],) + x.shape[1:])]) if x.shape[0] < max(sizes) else x
+    gathered = GatherLayer.apply(padded)
+
+    return torch.cat([g[:n] for g, n in zip(gathered, sizes)])
+
+def nt_xent_rows(z, queue, start, end, tau):
+    """
+    Returns the summed NT-Xent loss of the rows start:end of the normalized embeddings z, with shape [2N, embedding_dim],
+    where the positive of row i is row (i + N) mod 2N and the denominator has every other row and the rows of the
+    normalized queue of extra negatives, if it is not None.
+    """
+    n = z.shape[0] // 2
+    rows = torch.arange(start, end, device=z.device)
+
+    logits = z[start:end] @ z.t() / tau
+    logits = logits.masked_fill(F.one_hot(rows, 2 * n).bool(), float('-inf'))
+    positives = logits.gather(1, ((rows + n) % (2 * n)).unsqueeze(1)).squeeze(1)
+    if queue is not None:
+        logits = torch.cat([logits, z[start:end] @ queue.t() / tau], dim=1)
+
+    return (torch.logsumexp(logits, dim=1) - positives).sum()
+
+def nt_xent_loss(input1, input2, tau, chunk_size=None, queue=None):
+    """
+    SimCLR-style InfoNCE (NT-Xent) between two batches of embeddings, where (input1[i], input2[i]) are the positive pairs
+    and all the other 2N-2 embeddings are the negatives of each one.
+    The similarities come from a matmul of the normalized embeddings in float32 and the log of the denominator from a
+    logsumexp, so the memory is O(N^2) and large similarities / small temperatures do not overflow.
+    With chunk_size, the rows of the [2N, 2N] similarity matrix are computed chunk_size at a time, and recomputed in the
+    backward pass, so that only a [chunk_size, 2N] block is in memory at once.
+    With a queue of past embeddings (see EmbeddingQueue), they are added to the negatives of all the 2N embeddings.
+
+    Args:
+        input1: Embeddings of the clean/noisy images from the teacher/student. Size [N, embedding_dim].
+        input2: Embeddings of the clean/noisy images from the teacher/student (the ones not used as input1). Size [N, embedding_dim].
+        tau: the temperature
+        chunk_size: the number of rows of the similarity matrix computed at once, all of them if None
+        queue: extra negatives, size [Q, embedding_dim], or None
+
+    Returns:
+        loss: the sum of the losses of the 2N embeddings, divided by 2 (the mean over both directions of the N pairs, times N)
+    """
+    n = input1.shape[0]
+    z = F.normalize(torch.cat([input1, input2], dim=0).float(), dim=-1, eps=1e-8)
+    if queue is not None:
+        queue = F.normalize(queue.detach().float(), dim=-1, eps=1e-8)
+
+    if chunk_size is None or chunk_size >= 2 * n:
+        return nt_xent_rows(z, queue, 0, 2 * n, tau) / 2
+
+    loss = 0
+    for start in range(0, 2 * n, chunk_size):
+        rows = functools.partial(nt_xent_rows, queue=queue, start=start, end=min(start + chunk_size, 2 * n), tau=tau)
+        loss = loss + (checkpoint(rows, z) if z.requires_grad else rows(z))
+
+    return loss / 2
+
+def clip_loss(input1, input2, tau, queue=None):
+    """
+    CLIP-style InfoNCE between two batches of embeddings: the mean of the cross entropies of the positive pairs
+    (input1[i], input2[i]) among the rows and among the columns of the [N, N] similarity matrix.
+    With a queue of past input1 embeddings (see EmbeddingQueue), they are added to the candidates of every input2 embedding.
+
+    Args:
+        input1: Embeddings of the clean/noisy images from the teacher/student. Size [N, embedding_dim].
+        input2: Embeddings of the clean/noisy images from the teacher/student (the ones not used as input1). Size [N, embedding_dim].
+        tau: the temperature
+        queue: extra negatives for input2, size [Q, embedding_dim], or None
+    """
+    tensor1 = input1 / input1.norm(dim=-1, keepdim=True)
+    tensor2 = input2 / input2.norm(dim=-1, keepdim=True)
+    sim_mat = (1/tau)*tensor1 @ tensor2.t()
+
+    #Calculate the cross entropy between the similarities of the positive pairs, counted two ways
+    labels = torch.arange(input1.shape[0], device=input1.device)
+    part1 = F.cross_entropy(sim_mat, labels)
+    if queue is None:
+        part2 = F.cross_entropy(sim_mat.t(), labels)
+    else:
+        queue = queue.detach() / queue.detach().norm(dim=-1, keepdim=True)
+        part2 = F.cross_entropy(torch.cat([sim_mat.t(), (1/tau)*tensor2 @ queue.t().type_as(tensor2)], dim=1), labels)
+
+    return (part1+part2)/2
+
+class EmbeddingQueue(torch.nn.Module):
+    """
+    Fixed-size FIFO queue of past (teacher) embeddings, used as extra negatives by the contrastive losses.
+    With a frozen teacher, the queued embeddings stay consistent with the current ones, so no momentum encoder or extra
+    forward pass is needed. The queue is a non-persistent buffer, so it moves with the model but is not saved in checkpoints.
+
+    Args:
+        size: the maximum number of embeddings in the queue
+    """
+    def __init__(self, size):
+        super(EmbeddingQueue, self).__init__()
+        self.size = size
+        self.ptr = 0
+        self.length = 0
+        #allocated at the first enqueue, when the embedding size is known
+        self.register_buffer('embeddings', torch.zeros(0), persistent=False)
+
+    def get(self):
+        """
+        Returns the queued embeddings, size [length, embedding_dim], or None if the queue is empty.
+        """
+        if self.length == 0:
+            return None
+        return self.embeddings[:self.length]
+
+    @torch.no_grad()
+    def enqueue(self, embeddings):
+        """
+        Adds a batch of embeddings to the queue, replacing the oldest ones once it is full.
+        """
+        embeddings = embeddings.detach().float()[-self.size:]
+        if self.embeddings.dim() != 2 or self.embeddings.shape[1] != embeddings.shape[1]:
+            self.embeddings = torch.zeros(self.size, embeddings.shape[1], device=embeddings.device)
+            self.ptr, self.length = 0, 0
+
+        positions = (self.ptr + torch.arange(embeddings.shape[0], device=embeddings.device)) % self.size
+        self.embeddings[positions] = embeddings.to(self.embeddings.device)
+        self.ptr = (self.ptr + embeddings.shape[0]) % self.size
+        self.length = min(self.length + embeddings.shape[0], self.size)
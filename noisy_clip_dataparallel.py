@@ -9,30 +9,45 @@ from clip_files import model, clip
 import pickle
 
 from utils import *
+from losses import nt_xent_loss, clip_loss, EmbeddingQueue, gather_embeddings
 
 from pytorch_lightning import Trainer, LightningModule, LightningDataModule, seed_everything
 from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning.metrics import Accuracy
 from pytorch_lightning.callbacks import ModelCheckpoint
-from torch.utils.data  import DataLoader
+from torch.utils.data  import DataLoader, IterableDataset
 
 class ContrastiveUnsupervisedDataset(torch.utils.data.Dataset):
     """
     This class takes a dataset and creates a contrastive version of that dataset.
     Each item of the dataset is a tuple of a clean image and a noisy image (two
     separate transformations.)
+    With compact=True, transform_contrastive only crops the image to uint8 (ImageNetCropTrain/ImageNetCropVal) and each item
+    is the crop and its key (seed, index, epoch) instead; BatchDistortion.paired_views makes both images from them on the device.
+    With key_seed, transform_contrastive gets the key (key_seed, index, epoch) of every sample, as with KeyedDataset.
+    Set the epoch attribute at the start of every epoch.
     """
-    def __init__(self, clean_dataset, transform_contrastive=None, return_label=False):
+    def __init__(self, clean_dataset, transform_contrastive=None, return_label=False, compact=False, seed=0, key_seed=None):
         self.base = clean_dataset
         self.transform_contrastive = transform_contrastive
         self.return_label = return_label
+        self.compact = compact
+        self.seed = seed
+        self.key_seed = key_seed
+        self.epoch = 0
 
     def __len__(self):
         return len(self.base)
 
     def __getitem__(self, idx):
         image_orig, label = self.base[idx]
-        image_clean, image_noisy = self.transform_contrastive(image_orig) if self.transform_contrastive is not None else (image_orig, image_orig)
+        if self.compact:
+            #the key takes the place of the noisy image
+            image_clean, image_noisy = self.transform_contrastive(image_orig), torch.tensor([self.seed, idx, self.epoch])
+        elif self.key_seed is not None:
+            image_clean, image_noisy = self.transform_contrastive(image_orig, key=(self.key_seed, idx, self.epoch))
+        else:
+            image_clean, image_noisy = self.transform_contrastive(image_orig) if self.transform_contrastive is not None else (image_orig, image_orig)
         if self.return_label:
             return image_clean, image_noisy, label
         else:
@@ -67,31 +82,56 @@ class ImageNetCLIPDataset(LightningDataModule):
             else:
                 self.val_set_transform = ImageNetDistortVal(self.hparams)
 
+        #if the distortion is applied to the collated batch in NoisyCLIP.training_step, the workers only crop the images
+        self.batch_distortion = hasattr(self.hparams, 'batch_distortion') and self.hparams.batch_distortion
+        if self.batch_distortion:
+            self.train_set_transform = ImageNetCropTrain(self.hparams)
+
+        #with compact_pairs, the workers only send a uint8 crop and its key, and NoisyCLIP.training_step makes both images
+        self.compact_pairs = hasattr(self.hparams, 'compact_pairs') and self.hparams.compact_pairs
+        if self.compact_pairs:
+            self.batch_distortion = False
+            self.train_set_transform = ImageNetCropTrain(self.hparams, uint8=True)
+
+        #with teacher_table, the workers send a fixed uint8 crop and the teacher embedding of that crop from the precomputed table
+        self.teacher_table = self.hparams.teacher_table if hasattr(self.hparams, 'teacher_table') else None
+        if self.teacher_table:
+            self.batch_distortion = False
+
     def setup(self, stage=None):
-        train_data = ImageNet100(
-        	root=self.hparams.dataset_dir,
-            split="train",
-            transform=None
-        )
-        self.val_data = ImageNet100(
-            root=self.hparams.dataset_dir,
-            split="val",
-            transform=self.val_set_transform
-        )
+        # Stream the training images from tar shards if given, as (clean, noisy, label) unless the batch is distorted later.
+        train_stream = imagenet100_tar_dataset(self.hparams, split="train", transform=self.train_set_transform, paired=not self.batch_distortion)
+        if train_stream is not None and (self.compact_pairs or self.teacher_table):
+            raise ValueError('Compact pairs and teacher tables need indexed samples, use batch_distortion with uint8_transfer to stream tar shards.')
+        if train_stream is not None:
+            train_data = train_stream
+        else:
+            train_data = imagenet100_dataset(self.hparams, split="train", transform=self.train_set_transform if self.batch_distortion else None)
+        self.val_data = imagenet100_dataset(self.hparams, split="val", transform=self.val_set_transform)
 
         filename = self.hparams.dataset_dir + self.hparams.subset_file_name
 
         # Get the subset, as well as its labels as text.
         text_labels = list(train_data.idx_to_class.values())
 
-        self.train_contrastive = ContrastiveUnsupervisedDataset(train_data, transform_contrastive=self.train_set_transform, return_label=True)
+        if self.teacher_table:
+            self.train_contrastive = TeacherEmbeddingDataset(train_data, self.teacher_table, seed=teacher_seed(self.hparams))
+        elif self.compact_pairs:
+            self.train_contrastive = ContrastiveUnsupervisedDataset(train_data, transform_contrastive=self.train_set_transform, return_label=True, compact=True, seed=self.hparams.seed)
+        elif self.batch_distortion or train_stream is not None:
+            self.train_contrastive = train_data
+        else:
+            self.train_contrastive = ContrastiveUnsupervisedDataset(train_data, transform_contrastive=self.train_set_transform, return_label=True,
+                                                                    key_seed=distortion_seed(self.hparams, self.train_set_transform))
 
         # Save labels to be reused.
         if self.hparams.save_mapping_and_text:
             pickle.dump(text_labels, open(self.hparams.mapping_and_text_file, 'wb'))
 
     def train_dataloader(self):
-        return DataLoader(self.train_contrastive, batch_size=self.batch_size, num_workers=self.hparams.workers, pin_memory=True, shuffle=True)
+        # Streamed datasets shuffle their own samples.
+        shuffle = not isinstance(self.train_contrastive, IterableDataset)
+        return DataLoader(self.train_contrastive, batch_size=self.batch_size, num_workers=self.hparams.workers, pin_memory=True, shuffle=shuffle)
 
     def val_dataloader(self):
         return DataLoader(self.val_data, batch_size=2*self.batch_size, num_workers=self.hparams.workers, pin_memory=True, shuffle=False) # Only used for evaluation.
@@ -150,12 +190,34 @@ class NoisyCLIP(LightningModule):
                 else:
                     self.val_set_transform = ImageNetDistortVal(self.hparams)
 
+        #Optionally distort the collated batch in the training step instead of in the DataLoader workers
+        if hasattr(self.hparams, 'batch_distortion') and self.hparams.batch_distortion:
+            self.batch_distortion = BatchDistortion(self.hparams)
+            self.train_set_transform = ImageNetCropTrain(self.hparams)
+        else:
+            self.batch_distortion = None
+
+        #Optionally get each batch as uint8 crops and their keys, and make the clean and noisy images in the training step
+        self.compact_pairs = hasattr(self.hparams, 'compact_pairs') and self.hparams.compact_pairs
+        if self.compact_pairs:
+            self.batch_distortion = BatchDistortion(self.hparams)
+            self.train_set_transform = ImageNetCropTrain(self.hparams, uint8=True)
+
+        #Optionally read the clean embeddings from a table made by precompute_teacher.py instead of running the teacher in training
+        self.teacher_table = self.hparams.teacher_table if hasattr(self.hparams, 'teacher_table') else None
+        if self.teacher_table:
+            self.batch_distortion = BatchDistortion(self.hparams)
+
         #(2) set up the teacher CLIP network - freeze it and don't use gradients!
         self.logit_scale = self.hparams.logit_scale
         self.baseclip = clip.load(self.hparams.baseclip_type, self.hparams.device, jit=False)[0]
         self.baseclip.eval()
         self.baseclip.requires_grad_(False)
 
+        #the normalized text features of the class prompts, computed once from the frozen text tower and saved in the checkpoints
+        self.register_buffer('text_features', torch.zeros(0))
+        self.text_features_list = None
+
         #(3) set up the student CLIP network - unfreeze it and use gradients!
         self.noisy_visual_encoder = clip.load(self.hparams.baseclip_type, self.hparams.device, jit=False)[0].visual
         self.noisy_visual_encoder.train()
@@ -166,48 +228,30 @@ class NoisyCLIP(LightningModule):
         self.val_top_1 = Accuracy(top_k=1)
         self.val_top_5 = Accuracy(top_k=5)
 
-    def criterion(self, input1, input2, reduction='mean'):
+        #(5) optionally keep a FIFO queue of past teacher embeddings, used as extra negatives by the contrastive losses.
+        if hasattr(self.hparams, 'queue_size') and self.hparams.queue_size > 0:
+            self.queue = EmbeddingQueue(self.hparams.queue_size)
+        else:
+            self.queue = None
+
+    def criterion(self, input1, input2, reduction='mean', queue=None):
         """
         Args:
             input1: Embeddings of the clean/noisy images from the teacher/student. Size [N, embedding_dim].
             input2: Embeddings of the clean/noisy images from the teacher/student (the ones not used as input1). Size [N, embedding_dim].
             reduction: how to scale the final loss
+            queue: past teacher embeddings used as extra negatives by the simclr and clip losses, size [Q, embedding_dim], or None
         """
         bsz = input1.shape[0]
 
-        # Use the simclr style InfoNCE
+        #Use the simclr style InfoNCE, optionally computed a chunk of rows at a time
         if self.hparams.loss_type == 'simclr':
-            # Create similarity matrix between embeddings.
-            full_tensor = torch.cat([input1.unsqueeze(1),input2.unsqueeze(1)], dim=1).view(2*bsz, 1, -1)
-            tensor1 = full_tensor.expand(2*bsz,2*bsz,-1)
-            tensor2 = full_tensor.permute(1,0,2).expand(2*bsz,2*bsz,-1)
-            sim_mat = torch.nn.CosineSimilarity(dim=-1)(tensor1,tensor2)
-
-            # Calculate logits used for the contrastive loss.
-            exp_sim_mat = torch.exp(sim_mat/self.hparams.loss_tau)
-            mask = torch.ones_like(exp_sim_mat) - torch.eye(2*bsz).type_as(exp_sim_mat)
-            logmat = -torch.log(exp_sim_mat)+torch.log(torch.sum(mask*exp_sim_mat, 1))
-
-            #Grab the two off-diagonal similarities
-            part1 = torch.sum(torch.diag(logmat, diagonal=1)[np.arange(0,2*bsz,2)])
-            part2 = torch.sum(torch.diag(logmat, diagonal=-1)[np.arange(0,2*bsz,2)])
-
-            #Take the mean of the two off-diagonals
-            loss = (part1 + part2)/2
+            chunk_size = self.hparams.loss_chunk_size if hasattr(self.hparams, 'loss_chunk_size') else None
+            loss = nt_xent_loss(input1, input2, self.hparams.loss_tau, chunk_size=chunk_size, queue=queue)
 
         #Use the CLIP-style InfoNCE
         elif self.hparams.loss_type == 'clip':
-            # Create similarity matrix between embeddings.
-            tensor1 = input1 / input1.norm(dim=-1, keepdim=True)
-            tensor2 = input2 / input2.norm(dim=-1, keepdim=True)
-            sim_mat = (1/self.hparams.loss_tau)*tensor1 @ tensor2.t()
-
-            #Calculate the cross entropy between the similarities of the positive pairs, counted two ways
-            part1 = F.cross_entropy(sim_mat, torch.LongTensor(np.arange(bsz)).to(self.device))
-            part2 = F.cross_entropy(sim_mat.t(), torch.LongTensor(np.arange(bsz)).to(self.device))
-
-            #Take the mean of the two off-diagonals
-            loss = (part1+part2)/2
+            loss = clip_loss(input1, input2, self.hparams.loss_tau, queue=queue)
 
         #Take the simple MSE between the clean and noisy embeddings
         elif self.hparams.loss_type == 'mse':
@@ -241,12 +285,11 @@ class NoisyCLIP(LightningModule):
             image_features: the noisy image embeddings S(yi) where S() is the student and yi = Distort(xi). Shape [N, embedding_dim]
         """
 
-        #load the pre-computed text features and load them on the correct device
-        text_features = self.baseclip.encode_text(clip.tokenize(self.text_list).to(self.device))
+        #load the pre-computed (and normalized) text features
+        text_features = self.text_embeddings()
 
         # normalized features
         image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
 
         # cosine similarity as logits
         logits_per_image = self.logit_scale * image_features.type(torch.float16) @ text_features.type(torch.float16).t()
@@ -254,16 +297,66 @@ class NoisyCLIP(LightningModule):
 
         return logits_per_image, logits_per_text
 
+    def text_embeddings(self):
+        """
+        Returns the normalized text features of the class prompts in text_list, with shape [n_classes, embedding_dim].
+        The text tower is frozen, so they are only computed again if text_list changes.
+        """
+        if self.text_features_list != self.text_list or self.text_features.shape[0] != len(self.text_list):
+            with torch.no_grad():
+                text_features = self.baseclip.encode_text(clip.tokenize(self.text_list).to(self.device))
+            self.text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+            self.text_features_list = list(self.text_list)
+        return self.text_features
+
+    def on_save_checkpoint(self, checkpoint):
+        # Keep the prompts of the saved text features, to know if they are still valid when loading.
+        checkpoint['text_features_list'] = self.text_features_list
+
+    def on_load_checkpoint(self, checkpoint):
+        # Use the saved text features only if they were computed for the current prompts, and load older checkpoints without them.
+        state_dict = checkpoint['state_dict']
+        if checkpoint.get('text_features_list') == self.text_list and state_dict.get('text_features') is not None:
+            self.text_features = torch.empty_like(state_dict['text_features'])
+            self.text_features_list = list(self.text_list)
+        else:
+            state_dict['text_features'] = self.text_features
+
+    def on_validation_start(self):
+        # Compute the text features before the model is replicated, so that every batch reuses them.
+        self.text_embeddings()
+
     # Training methods - here we are concerned with contrastive loss (or MSE) between clean and noisy image embeddings.
+    def on_train_epoch_start(self):
+        # Streamed datasets reshuffle their shards and samples every epoch, and compact pairs get new keys.
+        set_epoch(self.trainer.train_dataloader, self.current_epoch)
+
     def training_step(self, train_batch, batch_idx):
         """
         Takes a batch of clean and noisy images and returns their respective embeddings.
+        If batch_distortion is set, takes a batch of cropped images and creates the clean and noisy images here.
+        If compact_pairs is set, the batch holds uint8 crops and their keys, and the noisy images are made from the keys.
+        If teacher_table is set, the batch holds uint8 crops and the precomputed teacher embeddings of the same crops.
 
         Returns:
             embed_clean: T(xi) where T() is the teacher and xi are clean images. Shape [N, embed_dim]
             embed_noisy: S(yi) where S() is the student and yi are noisy images. Shape [N, embed_dim]
         """
-        image_clean, image_noisy, labels = train_batch
+        if self.teacher_table:
+            images, embed_clean, labels = train_batch
+            embed_noisy = self.encode_noisy_image(self.batch_distortion(images))
+            return {'embed_clean': embed_clean.type_as(embed_noisy), 'embed_noisy': embed_noisy}
+
+        if self.compact_pairs:
+            images, keys, labels = train_batch
+            image_clean, image_noisy = self.batch_distortion.paired_views(images, keys)
+        elif self.batch_distortion is not None:
+            images, labels = train_batch
+            images = self.batch_distortion.to_float(images)
+            image_clean = self.batch_distortion.normalize(images)
+            image_noisy = self.batch_distortion(images)
+        else:
+            image_clean, image_noisy, labels = train_batch
         embed_clean = self.baseclip.encode_image(image_clean)
         embed_noisy = self.encode_noisy_image(image_noisy)
         return {'embed_clean': embed_clean, 'embed_noisy': embed_noisy}
@@ -271,10 +364,15 @@ class NoisyCLIP(LightningModule):
     def training_step_end(self, outputs):
         """
         Given all the clean and noisy image embeddings form across GPUs from training_step, gather them onto a single GPU and calculate overall loss.
+        With DDP, the embeddings of all the processes are gathered (with their gradients), so the loss uses the global batch.
         """
-        embed_clean_full = outputs['embed_clean']
-        embed_noisy_full = outputs['embed_noisy']
-        loss = self.criterion(embed_clean_full, embed_noisy_full)
+        embed_clean_full = gather_embeddings(outputs['embed_clean'])
+        embed_noisy_full = gather_embeddings(outputs['embed_noisy'])
+        if self.queue is not None:
+            loss = self.criterion(embed_clean_full, embed_noisy_full, queue=self.queue.get())
+            self.queue.enqueue(embed_clean_full)
+        else:
+            loss = self.criterion(embed_clean_full, embed_noisy_full)
         self.log('train_loss', loss, prog_bar=False, logger=True, sync_dist=True, on_step=True, on_epoch=True)
         return loss
 
@@ -315,20 +413,41 @@ class NoisyCLIP(LightningModule):
 
     # Default dataloaders - can be overwritten by datamodule.
     def train_dataloader(self):
-        if hasattr(self.hparams, 'increasing') and self.hparams.increasing:
-            datatf = ImageNetDistortTrainContrastive(self.hparams, epoch=self.current_epoch)
+        if self.teacher_table:
+            if hasattr(self.hparams, 'increasing') and self.hparams.increasing:
+                self.batch_distortion = BatchDistortion(self.hparams, epoch=self.current_epoch)
+
+            train_dataset = imagenet100_dataset(self.hparams, split='train', transform=None)
+            train_contrastive = TeacherEmbeddingDataset(train_dataset, self.teacher_table, seed=teacher_seed(self.hparams))
+        elif self.compact_pairs:
+            if hasattr(self.hparams, 'increasing') and self.hparams.increasing:
+                self.batch_distortion = BatchDistortion(self.hparams, epoch=self.current_epoch)
+
+            train_dataset = imagenet100_dataset(self.hparams, split='train', transform=None)
+            train_contrastive = ContrastiveUnsupervisedDataset(train_dataset, transform_contrastive=self.train_set_transform, return_label=True,
+                                                               compact=True, seed=self.hparams.seed)
+            train_contrastive.epoch = self.current_epoch
+        elif self.batch_distortion is not None:
+            if hasattr(self.hparams, 'increasing') and self.hparams.increasing:
+                self.batch_distortion = BatchDistortion(self.hparams, epoch=self.current_epoch)
+
+            train_contrastive = imagenet100_tar_dataset(self.hparams, split='train', transform=ImageNetCropTrain(self.hparams))
+            if train_contrastive is None:
+                train_contrastive = imagenet100_dataset(self.hparams, split='train', transform=ImageNetCropTrain(self.hparams))
         else:
-            datatf = self.train_set_transform
+            if hasattr(self.hparams, 'increasing') and self.hparams.increasing:
+                datatf = ImageNetDistortTrainContrastive(self.hparams, epoch=self.current_epoch)
+            else:
+                datatf = self.train_set_transform
 
-        train_dataset = ImageNet100(
-            root=self.hparams.dataset_dir,
-            split = 'train',
-            transform = None
-        )
-        train_contrastive = ContrastiveUnsupervisedDataset(train_dataset, transform_contrastive=datatf, return_label=True)
+            train_contrastive = imagenet100_tar_dataset(self.hparams, split='train', transform=datatf, paired=True)
+            if train_contrastive is None:
+                train_dataset = imagenet100_dataset(self.hparams, split='train', transform=None)
+                train_contrastive = ContrastiveUnsupervisedDataset(train_dataset, transform_contrastive=datatf, return_label=True,
+                                                                   key_seed=distortion_seed(self.hparams, datatf))
 
         train_dataloader = DataLoader(train_contrastive, batch_size=self.hparams.batch_size, num_workers=self.hparams.workers,\
-                                        pin_memory=True, shuffle=True)
+                                        pin_memory=True, shuffle=not isinstance(train_contrastive, IterableDataset))
 
         return train_dataloader
 
@@ -338,11 +457,7 @@ class NoisyCLIP(LightningModule):
         else:
             datatf = self.val_set_transform
 
-        val_dataset = ImageNet100(
-            root=self.hparams.dataset_dir,
-            split = 'val',
-            transform = datatf
-        )
+        val_dataset = imagenet100_dataset(self.hparams, split='val', transform=datatf)
         self.N_val = len(val_dataset)
 
         val_dataloader = DataLoader(val_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.workers,\
@@ -33,11 +33,12 @@ class ImageNet100Test(LightningDataModule):
             self.val_set_transform = ImageNetDistortVal(self.hparams)
 
     def setup(self, stage=None):
-        self.val_data = ImageNet100OOD(
+        #the transform is attached by eval_dataset, which can read cached center crops and key the distortions
+        self.val_data = eval_dataset(ImageNet100OOD(
             root=self.hparams.dataset_dir,
             split="val",
-            transform=self.val_set_transform
-        )
+            loader=eval_image_loader(self.hparams)
+        ), self.val_set_transform, self.hparams)
 
     def test_dataloader(self):
         return DataLoader(self.val_data, batch_size=512, num_workers=self.hparams.workers, worker_init_fn=(lambda wid: np.random.seed(int(torch.rand(1)[0]*1e6) + wid)), pin_memory=True, shuffle=False)
@@ -70,6 +71,10 @@ def noise_level_eval():
     )
     trainer = Trainer.from_argparse_args(args, logger=logger, progress_bar_refresh_rate=0)
 
+    # The configured seeds of the first repetition, the next ones are offset by the repetition.
+    first_mask_bank_seed = args.mask_bank_seed if hasattr(args, 'mask_bank_seed') else 0
+    first_distortion_seed = args.distortion_seed if hasattr(args, 'distortion_seed') else None
+
     for noise_level in args.noise_levels:
         all_results = []
         for test in range(args.num_tests):
@@ -92,6 +97,14 @@ def noise_level_eval():
                 args.kernel_size = noise_level[0]
                 args.sigma = noise_level[1]
 
+            # With a mask bank, every repetition draws a different but reproducible sequence of masks.
+            if hasattr(args, 'mask_bank_dir'):
+                args.mask_bank_seed = first_mask_bank_seed + test
+
+            # With a distortion seed, every repetition uses its own seed for the keyed distortions.
+            if first_distortion_seed is not None:
+                args.distortion_seed = first_distortion_seed + test
+
             test_data = ImageNet100Test(args)
             results = trainer.test(model=saved_model, datamodule=test_data, verbose=False)
             all_results.extend(results)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import json
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from utils import *
+from clip_files import clip
+
+class FixedCropsDataset(Dataset):
+    """
+    Every fixed augmentation of every image of a dataset, as (clean normalized crop, sample_index, k).
+    """
+    def __init__(self, dataset, num_augs, seed, batch_distortion):
+        self.dataset = dataset
+        self.num_augs = num_augs
+        self.crop = ImageNetFixedCropTrain(seed=seed)
+        self.batch_distortion = batch_distortion
+
+    def __len__(self):
+        return len(self.dataset) * self.num_augs
+
+    def __getitem__(self, i):
+        idx, k = divmod(i, self.num_augs)
+        image, _ = self.dataset[idx]
+        return self.batch_distortion.normalize(self.crop(image, idx, k).unsqueeze(0))[0], idx, k
+
+def load_teacher(args, teacher_type):
+    """
+    Returns the frozen teacher of the NoisyCLIP (clip) or KD baseline (resnet) models, as a function of the clean images.
+    """
+    if teacher_type == 'clip':
+        baseclip = clip.load(args.baseclip_type, args.device, jit=False)[0].eval()
+        return baseclip.encode_image
+    else:
+        from kd_baseline import RESNET_contrastive
+        return RESNET_contrastive(args).to(args.device).eval()
+
+def precompute_teacher(args, teacher_type):
+    """
+    Encodes the args.teacher_augs fixed augmentations of every training image of ImageNet100 with the teacher, and saves
+    the embeddings in a float16 table of shape [N, K, embedding_dim] at args.teacher_table, read by TeacherEmbeddingDataset.
+    The crop parameters and the image source are saved next to it in a .json file, and checked when the table is read.
+    """
+    dataset = imagenet100_dataset(args, split='train')
+    batch_distortion = BatchDistortion(argparse.Namespace(encoder=args.encoder, distortion="None"))
+    crops = FixedCropsDataset(dataset, args.teacher_augs, teacher_seed(args), batch_distortion)
+    teacher = load_teacher(args, teacher_type)
+
+    table = None
+    tmp_path = '{}.{}.tmp'.format(args.teacher_table, os.getpid())
+    loader = DataLoader(crops, batch_size=args.batch_size, num_workers=args.workers, pin_memory=True, shuffle=False)
+    with torch.no_grad():
+        for batch_idx, (images, idx, k) in enumerate(loader):
+            embeddings = teacher(images.to(args.device)).flatten(1).half().cpu().numpy()
+
+            #the embedding size is only known after the first batch
+            if table is None:
+                table = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                                  shape=(len(dataset), args.teacher_augs, embeddings.shape[1]))
+            table[idx.numpy(), k.numpy()] = embeddings
+
+            if batch_idx % 100 == 0:
+                print(str(batch_idx) + '/' + str(len(loader)))
+
+    table.flush()
+    del table
+
+    metadata = {'teacher': teacher_type, 'crop': crops.crop.params(), 'source': image_source(dataset)}
+    tmp_metadata = '{}.{}.tmp'.format(teacher_table_metadata(args.teacher_table), os.getpid())
+    with open(tmp_metadata, 'w') as f:
+        json.dump(metadata, f)
+    os.replace(tmp_metadata, teacher_table_metadata(args.teacher_table))
+    os.replace(tmp_path, args.teacher_table)
+
+def grab_config():
+    parser = argparse.ArgumentParser(description="NoisyCLIP")
+
+    parser.add_argument('--config_file')
+    parser.add_argument('--teacher', default='clip', choices=['clip', 'resnet'])
+
+    config = yaml_config_hook(parser.parse_args().config_file)
+    for k, v in config.items():
+        parser.add_argument(f"--{k}", default=v, type=type(v))
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == '__main__':
+    args = grab_config()
+    if not hasattr(args, 'device'):
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    precompute_teacher(args, args.teacher)
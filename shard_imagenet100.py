@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import numpy as np
+import torchvision.transforms as transforms
+
+from utils import ImageNet100
+
+IMAGENET100_DIR = './ImageNet100' #The path to the ImageNet100 folder created by slice_imagenet100.py
+SHARD_DIR = './ImageNet100_shards' #The destination for the pre-decoded shards - set shard_dir to this path in the yaml config files
+SHORT_SIDE = 256 #The images are resized so that their shorter side has this length, as in the validation transforms
+SHARD_BYTES = 2**31 #The approximate size of each shard file
+
+def shard_split(split):
+    """
+    Decodes every image of a split of ImageNet100 once, resizes it and appends it as a uint8 array to the shard files.
+    Also writes the offset index, the labels and the wnids of the split.
+    """
+    dataset = ImageNet100(root=IMAGENET100_DIR, split=split)
+    resize = transforms.Resize(SHORT_SIDE)
+
+    split_dir = os.path.join(SHARD_DIR, split)
+    if not os.path.isdir(split_dir):
+        os.makedirs(split_dir)
+
+    #one row of (shard, offset, height, width) per image
+    index = np.zeros((len(dataset), 4), dtype=np.int64)
+    labels = np.array(dataset.targets, dtype=np.int64)
+
+    shard, offset = 0, 0
+    f = open(os.path.join(split_dir, 'shard_{:04d}.bin'.format(shard)), 'wb')
+    for i, (path, _) in enumerate(dataset.samples):
+        image = np.asarray(resize(dataset.loader(path)), dtype=np.uint8)
+
+        if offset > 0 and offset + image.nbytes > SHARD_BYTES:
+            f.close()
+            shard, offset = shard + 1, 0
+            f = open(os.path.join(split_dir, 'shard_{:04d}.bin'.format(shard)), 'wb')
+
+        f.write(image.tobytes())
+        index[i] = (shard, offset, image.shape[0], image.shape[1])
+        offset += image.nbytes
+
+        if i % 10000 == 0:
+            print(split + ': ' + str(i) + '/' + str(len(dataset)))
+    f.close()
+
+    np.save(os.path.join(split_dir, 'index.npy'), index)
+    np.save(os.path.join(split_dir, 'labels.npy'), labels)
+    with open(os.path.join(split_dir, 'wnids.txt'), 'w') as f:
+        f.write('\n'.join(dataset.wnids) + '\n')
+
+def shard_imagenet100():
+    """
+    Converts the ImageNet100 folders to the pre-decoded shard format read by utils.ImageNet100Shards
+    """
+    #First make sure the directory we are given is correct!
+    if not os.path.isdir(IMAGENET100_DIR):
+        raise Exception("Bad filepath given")
+
+    for split in ['train', 'val']:
+        shard_split(split)
+
+    #copy the metadata bin file
+    shutil.copy(os.path.join(IMAGENET100_DIR, 'meta.bin'), os.path.join(SHARD_DIR, 'meta.bin'))
+
+if __name__ == '__main__':
+    shard_imagenet100()
@@ -2,65 +2,152 @@
 
 import os
 import sys
+import json
+import random
 import shutil
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
 ORIG_IMAGENET_DIR = './ILSVRC/Data/CLS-LOC' #The path to the ImageNet dataset - should point to the CLS-LOC folder root
 IMAGENET100_DIR = './ImageNet100' #The destination for the new ImageNet100 folder
 IMAGENET100_CLASSES = 'imagenet100.txt' #the file with the wnid names of the classes in the imagenet subset
 ZIP_PATH = './'
-
-def zip_imagenet100():
+WORKERS = 16 #the number of class folders copied at the same time
+HARDLINK = False #hardlink the images instead of copying them - the destination must be on the same filesystem
+MAKE_TAR = True #create the tar archive of the ImageNet100 folder
+MAKE_SHARDS = False #also write the pre-decoded shards of shard_imagenet100.py
+TAR_SHARDS = 0 #write this many shuffled tar shards for utils.ImageNet100Tar (at least DataLoader workers x GPUs), 0 for none
+TAR_SHARDS_DIR = './ImageNet100-shards' #the destination of the tar shards
+
+def sync_folder(src, dest, hardlink=False):
     """
-    Creates a data folder containing a 100-class subset of ImageNet, then creates a zipped copy of it
+    Makes dest a copy (or a set of hardlinks) of the files in src, only copying the files that are missing or have a
+    different size and removing the files that are not in src, so an up to date folder is left as it is.
+    Returns the number of copied files.
     """
-    #First make sure the directory we are given is correct!
-    if not os.path.isdir(ORIG_IMAGENET_DIR):
-        raise Exception("Bad filepath given")
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
 
-    #train and val directories to place the new image classes
-    new_train_root = os.path.join(IMAGENET100_DIR, 'train')
-    new_val_root = os.path.join(IMAGENET100_DIR, 'val')
+    src_files = {entry.name: entry.stat().st_size for entry in os.scandir(src) if entry.is_file()}
+    dest_files = {entry.name: entry.stat().st_size for entry in os.scandir(dest) if entry.is_file()}
 
-    #create the destiantion directories if they don't exist
-    if not os.path.isdir(IMAGENET100_DIR):
-        os.mkdir(IMAGENET100_DIR)
-        os.mkdir(new_train_root)
-        os.mkdir(new_val_root)
+    for name in dest_files:
+        if name not in src_files:
+            os.remove(os.path.join(dest, name))
 
-    class_path = os.path.join(ORIG_IMAGENET_DIR, IMAGENET100_CLASSES)
+    copied = 0
+    for name, size in src_files.items():
+        if dest_files.get(name) == size:
+            continue
 
-    #grab the subset wnids for the 100 class-subset
-    with open(class_path) as f:
-        subset_wnids = f.readlines()
-    subset_wnids = [x.strip() for x in subset_wnids] #list of the 100 WNIDs we grab
+        src_file, dest_file = os.path.join(src, name), os.path.join(dest, name)
+        if name in dest_files:
+            os.remove(dest_file)
+        if hardlink:
+            try:
+                os.link(src_file, dest_file)
+            except OSError:
+                shutil.copy2(src_file, dest_file)
+        else:
+            shutil.copy2(src_file, dest_file)
+        copied += 1
+
+    #verify the number of images of the class
+    num_src = len(src_files)
+    num_dest = sum(1 for entry in os.scandir(dest) if entry.is_file())
+    if num_src != num_dest:
+        raise Exception("Wrong number of files in {}: {} instead of {}".format(dest, num_dest, num_src))
+
+    return copied
+
+def sync_class_folders(src_root, dest_root, wnids, hardlink=False, workers=WORKERS):
+    """
+    Syncs the class folders of wnids from src_root to dest_root with a pool of threads, and removes the class folders
+    of dest_root that are not in wnids (e.g. after a change of the class list).
+    Returns the number of copied files.
+    """
+    if not os.path.isdir(dest_root):
+        os.makedirs(dest_root)
 
-    #paths to original train and val
-    train_path = os.path.join(ORIG_IMAGENET_DIR, 'train')
-    val_path = os.path.join(ORIG_IMAGENET_DIR, 'val')
+    for folder in os.listdir(dest_root):
+        if folder not in wnids and os.path.isdir(os.path.join(dest_root, folder)):
+            shutil.rmtree(os.path.join(dest_root, folder))
 
-    #grab the correct training direcotries
-    for folder in os.listdir(train_path):
-        folder_path = os.path.join(train_path, folder)
+    folders = [folder for folder in os.listdir(src_root) if folder in wnids and os.path.isdir(os.path.join(src_root, folder))]
+    if len(folders) != len(wnids):
+        raise Exception("Missing class folders in {}: {}".format(src_root, sorted(set(wnids) - set(folders))))
 
-        if not os.path.isdir(folder_path):
-            continue
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        copied = pool.map(lambda folder: sync_folder(os.path.join(src_root, folder), os.path.join(dest_root, folder), hardlink), folders)
 
-        if folder in subset_wnids:
-            dest_path = os.path.join(new_train_root, folder)
-            shutil.copytree(folder_path, dest_path)
+    return sum(copied)
 
+def write_tar_shards(src_dir, dest_dir, num_shards, seed=0, workers=WORKERS):
+    """
+    Writes the images of both splits of an ImageNet100 folder into num_shards tar files in dest_dir, streamed by
+    utils.ImageNet100Tar. The images of every split are shuffled and dealt to the shards in turn, so that every shard mixes
+    all the classes and holds the same number of images of each split, up to one. The numbers of images of every split in
+    every shard are saved in shards.json, which ImageNet100Tar uses to give all its readers the same number of samples.
+    Returns the paths of the shards.
+    """
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+
+    rng = random.Random(seed)
+    names = ['ImageNet100-{:04d}.tar'.format(shard) for shard in range(num_shards)]
+    members = [[] for _ in range(num_shards)]
+    counts = {}
+    for split in ['train', 'val']:
+        split_dir = os.path.join(src_dir, split)
+        files = sorted((wnid, name) for wnid in os.listdir(split_dir) if os.path.isdir(os.path.join(split_dir, wnid))
+                       for name in os.listdir(os.path.join(split_dir, wnid)))
+        rng.shuffle(files)
+
+        for i, (wnid, name) in enumerate(files):
+            members[i % num_shards].append((os.path.join(split_dir, wnid, name), '/'.join([split, wnid, name])))
+        counts[split] = {names[shard]: len(files[shard::num_shards]) for shard in range(num_shards)}
+
+    def write_shard(shard):
+        path = os.path.join(dest_dir, names[shard])
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with tarfile.open(tmp_path, 'w') as tar:
+            for src, arcname in members[shard]:
+                tar.add(src, arcname=arcname)
+        os.replace(tmp_path, path)
+        return path
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        paths = list(pool.map(write_shard, range(num_shards)))
+
+    #written last, so that it only lists complete shards
+    counts_path = os.path.join(dest_dir, 'shards.json')
+    with open(counts_path + '.tmp', 'w') as f:
+        json.dump(counts, f)
+    os.replace(counts_path + '.tmp', counts_path)
+
+    return paths
 
-    #grab the correcrt validation d9recotires
-    for folder in os.listdir(val_path):
-        folder_path = os.path.join(val_path, folder)
+def zip_imagenet100():
+    """
+    Creates a data folder containing a 100-class subset of ImageNet, then creates a zipped copy of it.
+    Running it again only copies the images that changed, e.g. for a new class list.
+    """
+    #First make sure the directory we are given is correct!
+    if not os.path.isdir(ORIG_IMAGENET_DIR):
+        raise Exception("Bad filepath given")
 
-        if not os.path.isdir(folder_path):
-            continue
+    class_path = os.path.join(ORIG_IMAGENET_DIR, IMAGENET100_CLASSES)
+
+    #grab the subset wnids for the 100 class-subset
+    with open(class_path) as f:
+        subset_wnids = f.readlines()
+    subset_wnids = set(x.strip() for x in subset_wnids if x.strip()) #set of the 100 WNIDs we grab
 
-        if folder in subset_wnids:
-            dest_path = os.path.join(new_val_root, folder)
-            shutil.copytree(folder_path, dest_path)
+    #grab the correct training and validation directories
+    for split in ['train', 'val']:
+        copied = sync_class_folders(os.path.join(ORIG_IMAGENET_DIR, split), os.path.join(IMAGENET100_DIR, split), subset_wnids, hardlink=HARDLINK)
+        print(split + ': copied ' + str(copied) + ' images')
 
     #copy the metadata bin file
     meta_file = os.path.join(ORIG_IMAGENET_DIR, 'meta.bin')
@@ -69,7 +156,18 @@ def zip_imagenet100():
     shutil.copy(meta_file, meta_dest)
 
     #Zip the destinatio file
-    shutil.make_archive(ZIP_PATH + '/ImageNet100', 'tar', IMAGENET100_DIR)
+    if MAKE_TAR:
+        shutil.make_archive(ZIP_PATH + '/ImageNet100', 'tar', IMAGENET100_DIR)
+
+    #Write the shuffled tar shards streamed by utils.ImageNet100Tar
+    if TAR_SHARDS:
+        write_tar_shards(IMAGENET100_DIR, TAR_SHARDS_DIR, TAR_SHARDS)
+
+    #Write the shards read by utils.ImageNet100Shards
+    if MAKE_SHARDS:
+        import shard_imagenet100
+        shard_imagenet100.IMAGENET100_DIR = IMAGENET100_DIR
+        shard_imagenet100.shard_imagenet100()
 
 if __name__ == '__main__':
     zip_imagenet100()
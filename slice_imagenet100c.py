@@ -3,16 +3,24 @@
 import os
 import sys
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
+from slice_imagenet100 import sync_folder
+
 DATA_SRC_ROOT = '/home/sriram/Projects/Datasets/ImageNet-C' #The path to the ImageNet-C dataset root - should contain 5 files of each distortion and meta.bin
 IMAGENET100_DIR = '/home/sriram/Projects/Datasets/ImageNet100C' #The destination for the new ImageNet100-C folder
 IMAGENET100_CLASSES = '/home/sriram/Projects/Datasets/Imagenet/imagenet100.txt' #the file with the wnid names of the classes in the imagenet subset
 ZIP_PATH = '/home/sriram/Projects/Datasets' #destination for the zipped ImageNet100C folder
+WORKERS = 16 #the number of class folders copied at the same time
+HARDLINK = False #hardlink the images instead of copying them - the destination must be on the same filesystem
+MAKE_TAR = True #create the tar archive of the ImageNet100C folder
 
 def zip_imagenet100c():
     """
-    Creates a data folder containing a 100-class subset of ImageNet, then creates a zipped copy of it
+    Creates a data folder containing a 100-class subset of ImageNet, then creates a zipped copy of it.
+    The class folders of all the distortions and levels are copied by a pool of threads, and running it again only
+    copies the images that changed, e.g. for a new class list.
     """
     #First make sure the directory we are given is correct!
     if not os.path.isdir(DATA_SRC_ROOT):
@@ -25,7 +33,10 @@ def zip_imagenet100c():
     #grab the subset wnids for the 100 class-subset
     with open(IMAGENET100_CLASSES) as f:
         subset_wnids = f.readlines()
-    subset_wnids = [x.strip() for x in subset_wnids] #list of the 100 WNIDs we grab
+    subset_wnids = set(x.strip() for x in subset_wnids if x.strip()) #set of the 100 WNIDs we grab
+
+    #(source, destination) of every class folder to copy
+    class_folders = []
 
     #Grab the names of all of the folders inside the root data source
     #Structure is distortion/sub_distortion/level/wnids
@@ -50,6 +61,13 @@ def zip_imagenet100c():
                 print(level)
 
                 level_path = os.path.join(subfolder_path, level)
+                dest_level_path = os.path.join(IMAGENET100_DIR, distortion, sub_distortion, level)
+
+                #remove the classes that are not in the subset anymore
+                if os.path.isdir(dest_level_path):
+                    for wnid in os.listdir(dest_level_path):
+                        if wnid not in subset_wnids and os.path.isdir(os.path.join(dest_level_path, wnid)):
+                            shutil.rmtree(os.path.join(dest_level_path, wnid))
 
                 #grab the correcrt validation d9recotires
                 for wnid in os.listdir(level_path):
@@ -59,9 +77,11 @@ def zip_imagenet100c():
                         continue
 
                     if wnid in subset_wnids:
-                        dest_path = os.path.join(IMAGENET100_DIR, distortion, sub_distortion, level, wnid)
+                        class_folders.append((wnid_path, os.path.join(dest_level_path, wnid)))
 
-                        shutil.copytree(wnid_path, dest_path)
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        copied = sum(pool.map(lambda folders: sync_folder(folders[0], folders[1], HARDLINK), class_folders))
+    print('copied ' + str(copied) + ' images')
 
     #copy the metadata bin file
     meta_file = os.path.join(DATA_SRC_ROOT, 'meta.bin')
@@ -70,7 +90,8 @@ def zip_imagenet100c():
     shutil.copy(meta_file, meta_dest)
 
     #Zip the destinatio file
-    shutil.make_archive(ZIP_PATH + '/ImageNet100C', 'tar', IMAGENET100_DIR)
+    if MAKE_TAR:
+        shutil.make_archive(ZIP_PATH + '/ImageNet100C', 'tar', IMAGENET100_DIR)
 
 if __name__ == '__main__':
     zip_imagenet100c()
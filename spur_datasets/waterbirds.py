@@ -21,7 +21,8 @@ DATASET_DIR = os.path.expanduser('~/datasets') # CHANGE THIS PER YOUR NEEDS
 # =================================================================
 
 class BirdSet(Dataset):
-    def __init__(self, root_dir=DATASET_DIR, transform=None, useful_getitem=True):
+    def __init__(self, root_dir=DATASET_DIR, transform=None, useful_getitem=True,
+                 cache_images=False):
         self.bird_dir = os.path.join(root_dir, 'waterbird_complete95_forest2water2')
         self.metadata = pd.read_csv(os.path.join(self.bird_dir, 'metadata.csv'))
 
@@ -60,8 +61,27 @@ class BirdSet(Dataset):
         self.split_array = self.metadata['split'].values
         self.split_dict = {'train':0, 'val': 1, 'test': 2}
 
+        # Full image paths, so that __getitem__ does not go through pandas
+        self.path_array = np.array([os.path.join(self.bird_dir, f) for f in self.filename_array])
+
+        # Sorted sample indices of every (split, group) pair, used by make_subset
+        self.groups = range(self.n_classes * 2**self.n_confounders)
+        self.index_table = {(split, group): np.flatnonzero((self.split_array == split) & (self.group_array == group))
+                            for split in self.split_dict.values() for group in self.groups}
+
         self.useful_getitem = useful_getitem
 
+        # Optional {idx: decoded uint8 image} cache, kept by each process
+        # (so use it with persistent DataLoader workers or none at all)
+        self.image_cache = {} if cache_images else None
+
+    def __getstate__(self):
+        # Workers start with an empty cache instead of a copy of this one
+        state = self.__dict__.copy()
+        if self.image_cache is not None:
+            state['image_cache'] = {}
+        return state
+
     def __len__(self):
         return len(self.metadata)
 
@@ -70,8 +90,13 @@ class BirdSet(Dataset):
         g = self.group_array[idx]
         a = self.confounder_array[idx]
 
-        img_name = os.path.join(self.bird_dir, self.metadata.iloc[idx, 1])
-        image = Image.open(img_name).convert('RGB')
+        if self.image_cache is not None and idx in self.image_cache:
+            image = Image.fromarray(self.image_cache[idx])
+        else:
+            img_name = self.path_array[idx]
+            image = Image.open(img_name).convert('RGB')
+            if self.image_cache is not None:
+                self.image_cache[idx] = np.asarray(image)
         sample = {'image': image, 'target': y,
                   'group': g, 'spurious': a}
         if self.transform:
@@ -87,33 +112,34 @@ class BirdSet(Dataset):
               group: [...]}
         """
         valid_filter_keys = ['group', 'split']
-        assert all([k in valid_filter_keys] for k in filter_dict)
+        assert all(k in valid_filter_keys for k in filter_dict)
 
         # Group filter first
-        group_idxs = None
+        groups = self.groups
         if 'group' in filter_dict:
             groups = filter_dict['group']
-            if isinstance(groups, int):
+            if isinstance(groups, (int, np.integer)):
                 groups = [groups]
-            group_idxs = set([i for i, _ in enumerate(self.group_array)
-                              if _ in groups])
+            invalid = [group for group in groups if group not in self.groups]
+            if invalid:
+                raise ValueError('Invalid groups {}, the groups are {}.'.format(invalid, list(self.groups)))
 
         # Split
-        split_idxs = None
+        splits = self.split_dict.values()
         if 'split' in filter_dict:
-            split_val = self.split_dict[filter_dict['split']]
-            split_idxs = set([i for i, _ in enumerate(self.split_array)
-                              if _ == split_val])
-
-        # And then take conjunctions:
-        if group_idxs is None:
-            idxs = split_idxs
-        elif split_idxs is None:
-            idxs = group_idxs
-        else:
-            idxs = split_idxs.intersection(group_idxs)
+            if filter_dict['split'] not in self.split_dict:
+                raise ValueError('Invalid split {}, the splits are {}.'.format(filter_dict['split'], list(self.split_dict)))
+            splits = [self.split_dict[filter_dict['split']]]
+
+        # An empty list of groups selects nothing (np.concatenate needs at least one array):
+        if len(groups) == 0:
+            return Subset(self, np.array([], dtype=int))
+
+        # And then take conjunctions, from the (split, group) table:
+        idxs = np.sort(np.concatenate([self.index_table[(split, group)]
+                                       for split in splits for group in set(groups)]))
 
-        return Subset(self, np.array(list(idxs)))
+        return Subset(self, idxs)
 
 
 
@@ -123,18 +149,25 @@ class BirdSet(Dataset):
 
 class BirdModule(pl.LightningDataModule):
     def __init__(self, root_dir=DATASET_DIR, transform=None, groups=None,
-                 batch_size=128):
+                 batch_size=128, num_workers=0, persistent_workers=False,
+                 prefetch_factor=2, pin_memory=False, cache_images=False):
         super().__init__()
         self.root_dir = root_dir
         self.transform = transform
         self.groups = groups
         self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.pin_memory = pin_memory
+        self.cache_images = cache_images
 
     def setup(self, stage=None):
         filter_dict = {}
         if self.groups is not None:
             filter_dict['group'] = self.groups
-        full_data = BirdSet(root_dir=self.root_dir, transform=self.transform)
+        full_data = BirdSet(root_dir=self.root_dir, transform=self.transform,
+                            cache_images=self.cache_images)
 
 
         filter_dict['split'] = 'train'
@@ -144,12 +177,24 @@ class BirdModule(pl.LightningDataModule):
         filter_dict['split'] = 'test'
         self.test_data = full_data.make_subset(filter_dict)
 
+    def loader_kwargs(self):
+        """ DataLoader options shared by all the splits; the worker options
+            are only valid with num_workers > 0
+        """
+        kwargs = {'batch_size': self.batch_size,
+                  'num_workers': self.num_workers,
+                  'pin_memory': self.pin_memory}
+        if self.num_workers > 0:
+            kwargs['persistent_workers'] = self.persistent_workers
+            kwargs['prefetch_factor'] = self.prefetch_factor
+        return kwargs
+
     def train_dataloader(self):
-        return DataLoader(self.train_data, batch_size=self.batch_size)
+        return DataLoader(self.train_data, **self.loader_kwargs())
 
     def val_dataloader(self):
-        return DataLoader(self.val_data, batch_size=self.batch_size)
+        return DataLoader(self.val_data, **self.loader_kwargs())
 
     def test_dataloader(self):
-        return DataLoader(self.test_data, batch_size=self.batch_size)
+        return DataLoader(self.test_data, **self.loader_kwargs())
 
@@ -0,0 +1,163 @@
+import io
+import os
+import tarfile
+import types
+
+import pytest
+import torch
+from torch.utils.data import Dataset, DataLoader
+from PIL import Image
+
+pl = pytest.importorskip('pytorch_lightning')
+
+import noisy_clip_dataparallel
+import kd_baseline
+import contrastive_baseline
+import slice_imagenet100
+from utils import ImageNet100Tar
+
+
+class ToyImages(Dataset):
+    def __len__(self):
+        return 8
+
+    def __getitem__(self, idx):
+        return torch.full((3, 4, 4), idx, dtype=torch.uint8), idx % 2
+
+
+class ToyModule(pl.LightningModule):
+    def __init__(self, dataset):
+        super(ToyModule, self).__init__()
+        self.dataset = dataset
+
+    def train_dataloader(self):
+        return DataLoader(self.dataset, batch_size=4, shuffle=False)
+
+
+def trainer_with_loader(dataset):
+    """
+    Returns a Trainer with the training dataloader it makes from the one of a module, as during fit.
+    """
+    trainer = pl.Trainer(max_epochs=1, logger=False, checkpoint_callback=False)
+    trainer.reset_train_dataloader(ToyModule(dataset))
+    return trainer
+
+
+@pytest.mark.parametrize('script, module', [(noisy_clip_dataparallel, noisy_clip_dataparallel.NoisyCLIP),
+                                            (kd_baseline, kd_baseline.NoisyContrastiveBaseline),
+                                            (contrastive_baseline, contrastive_baseline.NoisyContrastiveBaseline)])
+def test_compact_pairs_get_new_keys_every_epoch(script, module):
+    dataset = script.ContrastiveUnsupervisedDataset(ToyImages(), transform_contrastive=lambda image: image,
+                                                    return_label=True, compact=True, seed=7)
+    trainer = trainer_with_loader(dataset)
+    assert not isinstance(trainer.train_dataloader, DataLoader)
+
+    keys = []
+    for epoch in range(2):
+        module.on_train_epoch_start(types.SimpleNamespace(trainer=trainer, current_epoch=epoch))
+        keys.append(torch.cat([batch[1] for batch in trainer.train_dataloader.loaders]))
+
+    assert dataset.epoch == 1
+    assert keys[0][:, 2].tolist() == [0] * 8
+    assert keys[1][:, 2].tolist() == [1] * 8
+    assert keys[0][:, :2].tolist() == keys[1][:, :2].tolist()
+
+
+def make_tar_shards(root, num_shards=2, per_class=6):
+    """
+    Writes tar shards of a split with two classes of 1x1 PNG images, where the red value of every image is its index.
+    """
+    wnids = ['n00000001', 'n00000002']
+    with open(os.path.join(root, 'wnids.txt'), 'w') as f:
+        f.write('\n'.join(wnids))
+    torch.save(({wnid: (wnid,) for wnid in wnids},), os.path.join(root, 'meta.bin'))
+
+    index = 0
+    for shard in range(num_shards):
+        with tarfile.open(os.path.join(root, 'shard{}.tar'.format(shard)), 'w') as tar:
+            for wnid in wnids:
+                for _ in range(per_class // num_shards):
+                    data = io.BytesIO()
+                    Image.new('RGB', (1, 1), (index, 0, 0)).save(data, format='PNG')
+                    member = tarfile.TarInfo('ImageNet100/train/{}/{}.png'.format(wnid, index))
+                    member.size = data.tell()
+                    data.seek(0)
+                    tar.addfile(member, data)
+                    index += 1
+
+    return index
+
+
+def test_tar_shards_are_reshuffled_every_epoch(tmp_path):
+    num_images = make_tar_shards(str(tmp_path))
+    dataset = ImageNet100Tar(os.path.join(str(tmp_path), 'shard*.tar'), 'train', os.path.join(str(tmp_path), 'wnids.txt'),
+                             os.path.join(str(tmp_path), 'meta.bin'), transform=lambda image: image.getpixel((0, 0))[0],
+                             shuffle_buffer=4, length=num_images, seed=3)
+    trainer = trainer_with_loader(dataset)
+
+    orders = []
+    for epoch in range(2):
+        noisy_clip_dataparallel.NoisyCLIP.on_train_epoch_start(types.SimpleNamespace(trainer=trainer, current_epoch=epoch))
+        orders.append(torch.cat([batch[0] for batch in trainer.train_dataloader.loaders]).tolist())
+
+    assert sorted(orders[0]) == sorted(orders[1]) == list(range(num_images))
+    assert orders[0] != orders[1]
+
+
+def make_image_folder(root, num_train=13, num_val=2):
+    """
+    Writes an ImageNet100 folder with two classes of 1x1 PNG images, where the red value of every image is its index.
+    """
+    wnids = ['n00000001', 'n00000002']
+    with open(os.path.join(root, 'wnids.txt'), 'w') as f:
+        f.write('\n'.join(wnids))
+    torch.save(({wnid: (wnid,) for wnid in wnids},), os.path.join(root, 'meta.bin'))
+
+    index = 0
+    for split, num_images in [('train', num_train), ('val', num_val)]:
+        for wnid in wnids:
+            os.makedirs(os.path.join(root, 'ImageNet100', split, wnid))
+            for _ in range(num_images):
+                Image.new('RGB', (1, 1), (index, 0, 0)).save(os.path.join(root, 'ImageNet100', split, wnid, '{}.png'.format(index)))
+                index += 1
+
+
+def test_written_tar_shards_give_every_reader_the_same_number_of_images(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    make_image_folder(root)
+    paths = slice_imagenet100.write_tar_shards(os.path.join(root, 'ImageNet100'), os.path.join(root, 'shards'), 3, workers=2)
+    assert len(paths) == 3
+
+    dataset = ImageNet100Tar(os.path.join(root, 'shards', '*.tar'), 'train', os.path.join(root, 'wnids.txt'),
+                             os.path.join(root, 'meta.bin'), transform=lambda image: image.getpixel((0, 0))[0],
+                             shuffle_buffer=0, seed=3)
+    assert sorted(dataset.counts.values()) == [8, 9, 9]
+    assert len(dataset) == 26
+
+    #the classes are mixed in every shard
+    for path in paths:
+        assert len({label for _, label in dataset.read_shard(path)}) == 2
+
+    readers = []
+    for reader_id in range(2):
+        monkeypatch.setattr(dataset, 'worker_split', lambda reader_id=reader_id: (reader_id, 2))
+        readers.append([image for image, _ in dataset])
+    assert len(readers[0]) == len(readers[1]) >= 8
+    assert not set(readers[0]) & set(readers[1])
+
+    monkeypatch.setattr(dataset, 'worker_split', lambda: (0, 4))
+    with pytest.raises(ValueError):
+        next(iter(dataset))
+
+
+def test_distributed_tar_shards_need_image_counts(tmp_path, monkeypatch):
+    make_tar_shards(str(tmp_path))
+    dataset = ImageNet100Tar(os.path.join(str(tmp_path), 'shard*.tar'), 'train', os.path.join(str(tmp_path), 'wnids.txt'),
+                             os.path.join(str(tmp_path), 'meta.bin'))
+    assert dataset.counts is None
+
+    monkeypatch.setattr(torch.distributed, 'is_initialized', lambda: True)
+    monkeypatch.setattr(torch.distributed, 'get_rank', lambda: 0)
+    monkeypatch.setattr(torch.distributed, 'get_world_size', lambda: 2)
+    with pytest.raises(ValueError):
+        next(iter(dataset))
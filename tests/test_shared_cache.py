@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils
+
+
+class ToyFolder(object):
+    """
+    An image folder dataset of solid images, where the red value of an image is its index plus the offset of the split.
+    """
+    def __init__(self, split, num_samples, offset):
+        self.samples = [('/{}/{}.jpg'.format(split, i), 0) for i in range(num_samples)]
+        self.offset = offset
+
+    def loader(self, path):
+        return Image.new('RGB', (300, 260), (int(path[-5]) + self.offset, 0, 0))
+
+
+@pytest.fixture(autouse=True)
+def fresh_pool(monkeypatch):
+    monkeypatch.setattr(utils, '_SHARED_POOL', None)
+    monkeypatch.setattr(utils, '_SHARED_CACHES', {})
+
+
+def test_caches_share_one_budget_and_evict_images():
+    #room for 4 images, resized to 256 x 295
+    budget = 4 * 256 * 295 * 3
+    train = utils.SharedCacheDataset(ToyFolder('train', 6, 0), budget)
+    val = utils.SharedCacheDataset(ToyFolder('val', 3, 100), budget)
+    assert train.cache.pool is val.cache.pool
+    assert train.cache.pool.nbytes == budget
+
+    for ds, offset in [(train, 0), (val, 100), (train, 0)]:
+        for i in range(len(ds)):
+            assert np.asarray(ds[i][0])[0, 0, 0] == i + offset
+
+    #the pool holds the 4 most recently written images, whatever their dataset
+    cached = [train.cache.get(i) is not None for i in range(6)] + [val.cache.get(i) is not None for i in range(3)]
+    assert cached == [False, False, True, True, True, True, False, False, False]
+
+
+def test_reloaded_dataset_reuses_its_cache():
+    budget = 4 * 256 * 295 * 3
+    train = utils.SharedCacheDataset(ToyFolder('train', 2, 0), budget)
+    train[0]
+    reloaded = utils.SharedCacheDataset(ToyFolder('train', 2, 0), budget)
+    assert reloaded.cache is train.cache
+    assert reloaded.cache.get(0) is not None
+
+    with pytest.raises(ValueError):
+        utils.SharedCacheDataset(ToyFolder('val', 2, 0), 2 * budget)
+
+
+def test_budget_must_fit_in_shared_memory():
+    with pytest.raises(ValueError):
+        utils.SharedCacheDataset(ToyFolder('train', 2, 0), 2**60)
@@ -1,12 +1,30 @@
 import numpy as np
+import copy
+import functools
+import glob
+import hashlib
+import inspect
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
+import pickle
+import random
+import shutil
+import tarfile
+import tempfile
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 import torchvision
 import os
 import yaml
-from torch.utils.data.dataset import Dataset, Subset
-from torchvision.datasets import ImageFolder
-from torchvision.datasets.folder import make_dataset
+from PIL import Image
+from torch.utils.data import DataLoader
+from torch.utils.data.dataset import Dataset, IterableDataset, Subset
+from torchvision.datasets import ImageFolder, VisionDataset
+from torchvision.datasets.folder import make_dataset, default_loader, IMG_EXTENSIONS
 
 
 def convnoise(x, epoch=None):
@@ -15,54 +33,270 @@ def convnoise(x, epoch=None):
     else:
         return 0.9*x*(1-np.exp(-epoch/5)) + 0.1*x
 
+#constants of the splitmix64 generator, as signed int64
+_GAMMA = 0x9e3779b97f4a7c15 - 2**64
+_MIX1 = 0xbf58476d1ce4e5b9 - 2**64
+_MIX2 = 0x94d049bb133111eb - 2**64
+
+def _shr(z, s):
+    #logical right shift of int64 tensors (>> is arithmetic)
+    return (z >> s) & ((1 << (64 - s)) - 1)
+
+def _mix64(z):
+    #splitmix64 finalizer, with wrapping int64 arithmetic
+    z = (z ^ _shr(z, 30)) * _MIX1
+    z = (z ^ _shr(z, 27)) * _MIX2
+    return z ^ _shr(z, 31)
+
+def as_keys(key, device=None):
+    """
+    Converts a distortion key (seed, sample_index, epoch), or a batch of keys, to a LongTensor of shape [N, 3].
+    """
+    if not torch.is_tensor(key):
+        key = torch.tensor(key, dtype=torch.long)
+    return key.to(device=device, dtype=torch.long).view(-1, 3)
+
+def counter_bits(keys, n, stream=0):
+    """
+    Counter-based random generator: the i-th value for a key only depends on (key, stream, i), through a splitmix64 hash.
+    This does not use or change any global RNG state, so the values are the same in any DataLoader worker and between runs.
+
+    Arguments:
+        keys - a LongTensor of shape [N, 3] of (seed, sample_index, epoch) keys
+        n - the number of values to draw for each key
+        stream - the index of the random quantity drawn with the key, so that different quantities are independent
+
+    Returns:
+        bits - a LongTensor of shape [N, n] of random 64 bit values
+    """
+    state = _mix64((keys[:, 0] + 1) * _GAMMA)
+    state = _mix64(state + (keys[:, 1] + 1) * _GAMMA)
+    state = _mix64(state + (keys[:, 2] + 1) * _GAMMA)
+    state = _mix64(state + torch.full_like(state, stream + 1) * _GAMMA)
+    counter = torch.arange(1, n + 1, device=keys.device).unsqueeze(0)
+
+    return _mix64(state.unsqueeze(1) + counter * _GAMMA)
+
+def counter_uniform(keys, n, stream=0):
+    """
+    Draws n uniform values in (0, 1) for each key with the counter-based generator (see counter_bits).
+
+    Returns:
+        u - a float tensor of shape [N, n]
+    """
+    return (_shr(counter_bits(keys, n, stream), 40).float() + 0.5) * 2**-24
+
+def counter_normal(keys, n, stream=0):
+    """
+    Draws n standard normal values for each key with the counter-based generator (see counter_bits), with Box-Muller.
+
+    Returns:
+        z - a float tensor of shape [N, n]
+    """
+    m = (n + 1) // 2
+    u = counter_uniform(keys, 2*m, stream)
+    radius = torch.sqrt(-2*torch.log(u[:, :m]))
+    angle = 2*np.pi*u[:, m:]
+
+    return torch.cat([radius*torch.cos(angle), radius*torch.sin(angle)], dim=1)[:, :n]
+
+def sample_removed_num(percent_missing, n, h, w, device=None, keys=None):
+    """
+    Draws the number of missing pixels for each of n random masks of size (h, w).
+
+    Arguments:
+        percent_missing - the percent of pixels to mask. Can be a list of [low, high] to choose uniformly randomly in [low, high] for each mask
+        n - the number of masks
+        h, w - the size of the masks
+        keys - optional [n, 3] keys to draw the percents with the counter-based generator instead of the global RNG
+
+    Returns:
+        removed_num - a LongTensor of shape [n] with the number of missing pixels in each mask
+    """
+    if isinstance(percent_missing, list):
+        low, high = percent_missing
+        if keys is not None:
+            u = counter_uniform(keys.to(device), 1, stream=0)[:, 0].double()
+        else:
+            u = torch.rand(n, dtype=torch.float64, device=device)
+        percent = low + (high - low) * u
+    else:
+        percent = torch.full((n,), percent_missing, dtype=torch.float64, device=device)
+
+    return (h * w * percent).long()
+
+def random_mask_batch(removed_num, h, w, keys=None):
+    """
+    Creates a batch of random masks, each with an exact number of missing pixels (set to 0).
+
+    Instead of drawing a permutation of all the pixels for every mask, the pixels are ranked by uniform noise and a partial
+    selection (topk) picks the smallest (missing) or largest (kept) ones, whichever set is smaller.
+
+    Arguments:
+        removed_num - a LongTensor of shape [N] with the number of missing pixels in each mask
+        h, w - the size of the masks
+        keys - optional [N, 3] keys to draw the noise with the counter-based generator instead of the global RNG
+
+    Returns:
+        masks - a float tensor of shape [N, h, w] with 0 for missing pixels and 1 otherwise
+    """
+    n = removed_num.shape[0]
+    kept_num = h * w - removed_num
+    if keys is not None:
+        noise = counter_uniform(keys.to(removed_num.device), h * w, stream=1)
+    else:
+        noise = torch.rand(n, h * w, device=removed_num.device)
+
+    if int(removed_num.max()) <= int(kept_num.max()):
+        #select the missing pixels: the ones with the smallest noise
+        k = int(removed_num.max())
+        masks = torch.ones(n, h * w, device=removed_num.device)
+        selected = noise.topk(k, dim=1, largest=False, sorted=True).indices
+        masks.scatter_(1, selected, (torch.arange(k, device=removed_num.device).unsqueeze(0) >= removed_num.unsqueeze(1)).float())
+    else:
+        #select the kept pixels: the ones with the largest noise
+        k = int(kept_num.max())
+        masks = torch.zeros(n, h * w, device=removed_num.device)
+        selected = noise.topk(k, dim=1, largest=True, sorted=True).indices
+        masks.scatter_(1, selected, (torch.arange(k, device=removed_num.device).unsqueeze(0) < kept_num.unsqueeze(1)).float())
+
+    return masks.view(n, h, w)
+
 class RandomMask(object):
     """
     Custom Torchvision transform meant to be used on image data with dimension (N, C, H, W).
     Mask an image with a random mask of missing pixels (blacked out - values set to 0).
+    Given a batch of images, each image gets its own mask.
+    If a key (seed, sample_index, epoch) is given, or a batch of keys, the masks only depend on the key (see counter_bits).
 
     Args:
         percent_missing: percent of the pixels to mask
         fixed: whether the mask is fixed for all images
+        bank: an optional MaskBank of precomputed masks to draw the masks from
     """
 
-    def __init__(self, percent_missing, fixed=False):
+    def __init__(self, percent_missing, fixed=False, bank=None):
         assert isinstance(percent_missing, float) or isinstance(percent_missing, list)
 
         self.percent_missing = percent_missing
         self.fixed = fixed
         self.mask = None
+        self.bank = bank
 
-    def __call__(self, image):
+    def __call__(self, image, key=None):
         h, w = image.shape[-2:]
+
+        #a batch of images gets a batch of different masks, generated at once
+        if image.dim() == 4 and not self.fixed and self.bank is None:
+            keys = as_keys(key, image.device) if key is not None else None
+            removed_num = sample_removed_num(self.percent_missing, image.shape[0], h, w, device=image.device, keys=keys)
+            return image*random_mask_batch(removed_num, h, w, keys=keys).unsqueeze(1).type_as(image)
+
+        return image*self.sample_mask(h, w, key).to(image.device)
+
+    def sample_mask(self, h, w, key=None):
+        """
+        Returns the mask for the next image, reusing the fixed mask or drawing from the mask bank if needed.
+        """
         if self.fixed and self.mask is not None:
-            return image*self.mask.view(h,w)
+            return self.mask
+
+        if self.bank is not None and not self.fixed:
+            return self.bank.next_mask(h, w, key)
+
+        mask = self.get_mask(h, w, key)
+        if self.fixed:
+            self.mask = mask
+
+        return mask
+
+    def get_mask(self, h, w, key=None):
+        """
+        Draws a single random mask of shape [h, w], from the global RNG or from the counter-based generator with the given key.
+        """
+        if key is not None:
+            keys = as_keys(key)
+            return random_mask_batch(sample_removed_num(self.percent_missing, 1, h, w, keys=keys), h, w, keys=keys)[0]
 
         if isinstance(self.percent_missing, float):
             removed_num = int(h*w*self.percent_missing)
         else:
             removed_percent = np.random.uniform(self.percent_missing[0], self.percent_missing[1])
             removed_num = int(h*w*removed_percent)
-        removed_secs = np.random.choice(h*w, removed_num, replace=False)
+        #partial selection of the removed_num pixels with the smallest uniform noise, instead of a full permutation
+        removed_secs = np.argpartition(np.random.random(h*w), removed_num-1)[:removed_num] if removed_num > 0 else []
         mask = torch.ones(h*w)
         mask[removed_secs] = 0
-        if self.fixed:
-            self.mask = mask
 
-        return image*mask.view(h, w)
+        return mask.view(h, w)
+
+def sample_square_offsets(n, h, w, length, offset="random", device=None, keys=None):
+    """
+    Draws the top-left corners of n square masks of size (h, w), following the offsets of SquareMask.
+    The masked square covers 2*(length//2) rows and columns starting from the corner.
+
+    Arguments:
+        n - the number of masks
+        h, w - the size of the masks
+        length - side length of the square masked area
+        offset - "center" or "random", as in SquareMask
+        keys - optional [n, 3] keys to draw the offsets with the counter-based generator instead of the global RNG
+
+    Returns:
+        top, left - LongTensors of shape [n] with the first masked row and column of each mask
+    """
+    side = 2*(length//2)
+    if offset == "random" and keys is not None:
+        u = counter_uniform(keys.to(device), 2, stream=2)
+        top = (u[:, 0] * (h - side + 1)).long().clamp_(max=h - side)
+        left = (u[:, 1] * (w - side + 1)).long().clamp_(max=w - side)
+    elif offset == "random":
+        top = torch.randint(0, h - side + 1, (n,), device=device)
+        left = torch.randint(0, w - side + 1, (n,), device=device)
+    else:
+        top = torch.full((n,), h//2 - length//2, dtype=torch.long, device=device)
+        left = torch.full((n,), w//2 - length//2, dtype=torch.long, device=device)
+
+    return top, left
+
+def square_mask_batch(top, left, side, h, w):
+    """
+    Creates a batch of square masks with a different position for each mask, without building index arrays.
+
+    Arguments:
+        top, left - LongTensors of shape [N] with the first masked row and column of each mask
+        side - the side length of the masked squares
+        h, w - the size of the masks
+
+    Returns:
+        masks - a float tensor of shape [N, h, w] with 0 for missing pixels and 1 otherwise
+    """
+    rows = torch.arange(h, device=top.device).unsqueeze(0)
+    cols = torch.arange(w, device=top.device).unsqueeze(0)
+    in_rows = (rows >= top.unsqueeze(1)) & (rows < top.unsqueeze(1) + side)
+    in_cols = (cols >= left.unsqueeze(1)) & (cols < left.unsqueeze(1) + side)
+
+    return (~(in_rows.unsqueeze(2) & in_cols.unsqueeze(1))).float()
 
 class SquareMask(object):
     """
     Custom Torchvision transform meant to be used on image data with dimension (N, C, H, W).
     Mask an image with a square mask of missing pixels
+    Given a batch of images with offset="random", each image gets its own random offset.
+    If a key (seed, sample_index, epoch) is given, or a batch of keys, the offsets only depend on the key (see counter_bits).
 
     Args:
         length: side length of the square masked area
         offset: {"center": center the square in the image,
                 "random": perform a random vertical and horizontal offset of the square}
         fixed: whether the mask is the same for all images (only useful with offset="random")
+        bank: an optional MaskBank of precomputed masks to draw the masks from
     """
 
-    def __init__(self, length, offset="center", fixed=False):
+    #the center masks never change, so they are shared for every (h, w, length)
+    center_masks = {}
+
+    def __init__(self, length, offset="center", fixed=False, bank=None):
         viable_offsets = ["center", "random"]
 
         assert isinstance(offset, str)
@@ -74,51 +308,60 @@ class SquareMask(object):
         self.length = length
         self.fixed = fixed
         self.mask = None
+        self.bank = bank
 
-    def __call__(self, image):
+    def __call__(self, image, key=None):
         h, w = image.shape[-2:]
         assert (self.length < h and self.length < w)
 
-        if self.fixed and self.mask is not None:
-            return image*self.mask
+        #a batch of images gets a batch of different random offsets, masked at once
+        if image.dim() == 4 and self.offset == "random" and not self.fixed and self.bank is None:
+            keys = as_keys(key, image.device) if key is not None else None
+            top, left = sample_square_offsets(image.shape[0], h, w, self.length, self.offset, device=image.device, keys=keys)
+            return image*square_mask_batch(top, left, 2*(self.length//2), h, w).unsqueeze(1).type_as(image)
 
-        if self.offset == "random":
-            #The random offsets define the center of the square region
-            h_offset = np.random.choice(np.arange(self.length//2, h-(self.length//2)+1))
-            w_offset = np.random.choice(np.arange(self.length//2, w-(self.length//2)+1))
+        return image*self.sample_mask(h, w, key).to(image.device)
 
-            removed_secs_h = np.arange(h_offset-(self.length//2), h_offset+(self.length//2))
-            removed_secs_w = np.arange(w_offset-(self.length//2), w_offset+(self.length//2))
+    def sample_mask(self, h, w, key=None):
+        """
+        Returns the mask for the next image, reusing the fixed mask or drawing from the mask bank if needed.
+        """
+        if self.fixed and self.mask is not None:
+            return self.mask
 
-            x, y = np.meshgrid(removed_secs_h, removed_secs_w)
+        if self.bank is not None and not self.fixed:
+            return self.bank.next_mask(h, w, key)
 
-            mask = torch.ones(h, w)
-            mask[x, y] = 0
-            if self.fixed:
-                self.mask = mask
+        mask = self.get_mask(h, w, key)
+        if self.fixed:
+            self.mask = mask
 
-            return image*mask
+        return mask
 
-        elif self.offset == "center":
-            #The center offsets here are in the middle of the image
-            h_offset = h//2
-            w_offset = w//2
+    def get_mask(self, h, w, key=None):
+        """
+        Draws a single square mask of shape [h, w], from the global RNG or from the counter-based generator with the given key.
+        The center mask is cached and must not be modified.
+        """
+        if self.offset == "center" and (h, w, self.length) in SquareMask.center_masks:
+            return SquareMask.center_masks[(h, w, self.length)]
 
-            removed_secs_h = np.arange(h_offset-(self.length//2), h_offset+(self.length//2))
-            removed_secs_w = np.arange(w_offset-(self.length//2), w_offset+(self.length//2))
+        keys = as_keys(key) if key is not None else None
+        top, left = sample_square_offsets(1, h, w, self.length, self.offset, keys=keys)
+        top, left, side = int(top), int(left), 2*(self.length//2)
 
-            x, y = np.meshgrid(removed_secs_h, removed_secs_w)
+        mask = torch.ones(h, w)
+        mask[top:top+side, left:left+side] = 0
 
-            mask = torch.ones(h, w)
-            mask[x, y] = 0
-            if self.fixed:
-                self.mask = mask
+        if self.offset == "center":
+            SquareMask.center_masks[(h, w, self.length)] = mask
 
-            return image*mask
+        return mask
 
 class GaussianNoise(object):
     """
     Torchvision transform to add random Gaussian noise to an input image.
+    If a key (seed, sample_index, epoch) is given, the noise only depends on the key (see counter_bits).
 
     Arguments:
         std - the standard deviation of the random noise to add to the image.
@@ -130,22 +373,529 @@ class GaussianNoise(object):
         self.fixed = fixed
         self.noise = None
 
-    def __call__(self, image):
+    def __call__(self, image, key=None):
         c, h, w = image.shape[-3:]
 
-        if self.fixed and self.noise is not None:
-            return image + self.noise
+        return image + self.sample_noise(c, h, w, key=key)
 
-        if isinstance(self.std, list):
-            std = np.random.uniform(low=self.std[0], high=self.std[1])
-            noise = torch.randn((c, h, w)) * std
+    def sample_noise(self, c, h, w, out=None, key=None):
+        """
+        Returns the noise for the next image, reusing the fixed noise if needed.
+        If given, the noise is written into the tensor out.
+        """
+        if self.fixed and self.noise is not None:
+            return self.noise if out is None else out.copy_(self.noise)
+
+        if key is not None:
+            keys = as_keys(key)
+            std = self.std
+            if isinstance(self.std, list):
+                std = self.std[0] + (self.std[1] - self.std[0]) * float(counter_uniform(keys, 1, stream=0))
+            noise = counter_normal(keys, c*h*w, stream=1).view(c, h, w)
+            noise = noise.mul_(std) if out is None else torch.mul(noise, std, out=out)
         else:
-            noise = torch.randn((c, h, w)) * self.std
+            if isinstance(self.std, list):
+                std = np.random.uniform(low=self.std[0], high=self.std[1])
+            else:
+                std = self.std
+            noise = torch.randn((c, h, w), out=out).mul_(std)
 
         if self.fixed:
-            self.noise = noise
+            self.noise = noise.clone()
+
+        return noise
+
+@functools.lru_cache(maxsize=None)
+def gaussian_kernel1d(kernel_size, sigma):
+    """
+    Returns the 1D Gaussian kernel of transforms.GaussianBlur for a given (kernel_size, sigma), as a float tensor of shape [kernel_size].
+    The kernels are cached, so the returned tensor must not be modified.
+    """
+    return gaussian_kernels1d(kernel_size, torch.tensor([float(sigma)]))[0]
+
+def gaussian_kernels1d(kernel_size, sigma):
+    """
+    Computes a batch of 1D Gaussian kernels of size kernel_size, for a float tensor of standard deviations sigma with shape [N].
+
+    Returns:
+        kernels - a float tensor of shape [N, kernel_size], where every kernel sums to 1
+    """
+    half = (kernel_size - 1) * 0.5
+    x = torch.linspace(-half, half, steps=kernel_size, device=sigma.device)
+    pdf = torch.exp(-0.5 * (x.unsqueeze(0) / sigma.unsqueeze(1)).pow(2))
+
+    return pdf / pdf.sum(dim=1, keepdim=True)
+
+def gaussian_blur_batch(images, kernel_size, sigma):
+    """
+    Blurs a batch of images with a Gaussian kernel, equivalent to transforms.GaussianBlur (with reflect padding).
+    The 2D kernel is separable, so the images are convolved with the 1D kernel along the rows and then along the columns,
+    with 2*kernel_size instead of kernel_size**2 operations per pixel. Every channel of every image is a group of a single conv2d.
+
+    Arguments:
+        images - a float tensor of shape [N, C, H, W]
+        kernel_size - the odd size of the kernel
+        sigma - the standard deviation of the kernel, either a number for all the images or a tensor of shape [N]
+
+    Returns:
+        blurred - a float tensor of shape [N, C, H, W]
+    """
+    n, c, h, w = images.shape
+    if torch.is_tensor(sigma):
+        kernels = gaussian_kernels1d(kernel_size, sigma.to(device=images.device, dtype=torch.float32))
+        kernels = kernels.repeat_interleave(c, dim=0)
+        x = images.reshape(1, n*c, h, w)
+    else:
+        kernels = gaussian_kernel1d(kernel_size, float(sigma)).to(images.device).expand(c, -1)
+        x = images
+    kernels = kernels.to(images.dtype)
+    groups = kernels.shape[0]
+
+    pad = kernel_size // 2
+    x = F.pad(x, [pad, pad, pad, pad], mode="reflect")
+    x = F.conv2d(x, kernels.reshape(groups, 1, 1, kernel_size), groups=groups)
+    x = F.conv2d(x, kernels.reshape(groups, 1, kernel_size, 1), groups=groups)
+
+    return x.reshape(n, c, h, w)
+
+class GaussianBlur(object):
+    """
+    Torchvision transform to blur an image with a Gaussian kernel. Same as transforms.GaussianBlur, but separable
+    (see gaussian_blur_batch) and able to blur a whole batch of images with dimension (N, C, H, W) at once.
+    If a key (seed, sample_index, epoch) is given, or a batch of keys, a random sigma only depends on the key (see counter_bits).
 
-        return image + noise
+    Arguments:
+        kernel_size - the odd size of the kernel
+        sigma - the standard deviation of the kernel.
+                Can be a list of [low, high] to choose uniformly randomly in [low, high] for each image
+    """
+    def __init__(self, kernel_size, sigma=[0.1, 2.0]):
+        assert kernel_size % 2 == 1
+
+        self.kernel_size = kernel_size
+        self.sigma = list(sigma) if isinstance(sigma, (list, tuple)) else float(sigma)
+
+    def __call__(self, image, key=None):
+        images = image if image.dim() == 4 else image.unsqueeze(0)
+        sigma = self.sample_sigma(images.shape[0], key, device=image.device)
+        blurred = gaussian_blur_batch(images, self.kernel_size, sigma)
+
+        return blurred if image.dim() == 4 else blurred[0]
+
+    def sample_sigma(self, n, key=None, device=None):
+        """
+        Returns the sigma for the next n images: the fixed sigma, or a tensor of shape [n] of random sigmas.
+        """
+        if not isinstance(self.sigma, list):
+            return self.sigma
+
+        low, high = self.sigma
+        if key is not None:
+            u = counter_uniform(as_keys(key, device), 1, stream=0)[:, 0]
+        else:
+            u = torch.rand(n, device=device)
+        return low + (high - low) * u
+
+def rgb_to_grayscale_batch(images):
+    """
+    Converts float RGB images with shape [..., 3, H, W] to grayscale with shape [..., 1, H, W], as torchvision does.
+    """
+    r, g, b = images.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)
+
+def adjust_hue_batch(images, hue_factor):
+    """
+    Shifts the hue of a batch of float RGB images with shape [N, 3, H, W] in [0, 1], with a hue_factor per image of shape [N].
+    Same as torchvision's adjust_hue, but the value and saturation are kept as max and max - min of the channels instead of
+    being converted to HSV and back, and all the channels are computed at once.
+    """
+    r, g, b = images.unbind(dim=1)
+    maxc = torch.max(torch.max(r, g), b)
+    cr = maxc - torch.min(torch.min(r, g), b)
+    cr_divisor = torch.where(cr == 0, torch.ones_like(cr), cr)
+
+    h = torch.where(maxc == r, (g - b) / cr_divisor, torch.where(maxc == g, 2.0 + (b - r) / cr_divisor, 4.0 + (r - g) / cr_divisor))
+    h = torch.remainder(h / 6.0 + hue_factor.view(-1, 1, 1).to(images.dtype), 1.0)
+
+    #channel = v - v*s*clamp(min(k, 4 - k), 0, 1), with k = (n + 6*h) mod 6, n = 5, 3, 1 for R, G, B and v*s = max - min
+    k = torch.remainder(torch.tensor([5.0, 3.0, 1.0], dtype=images.dtype, device=images.device).view(1, 3, 1, 1) + 6 * h.unsqueeze(1), 6)
+
+    return maxc.unsqueeze(1) - cr.unsqueeze(1) * torch.min(k, 4 - k).clamp_(0, 1)
+
+class ColorJitter(object):
+    """
+    Torchvision transform to randomly change the brightness, contrast, saturation and hue of an image, like transforms.ColorJitter,
+    but on tensors with dimension (C, H, W) in [0, 1] or on whole batches (N, C, H, W).
+    Every image gets its own random factors and its own random order of the four adjustments. Each adjustment is applied
+    at once to the images that have it at the same position in their order.
+    If a key (seed, sample_index, epoch) is given, or a batch of keys, the factors and order only depend on the key.
+
+    Arguments:
+        brightness, contrast, saturation - the factors are chosen uniformly in [max(0, 1 - x), 1 + x]
+        hue - the hue factor is chosen uniformly in [-hue, hue], with 0 <= hue <= 0.5
+    """
+    def __init__(self, brightness=0, contrast=0, saturation=0, hue=0):
+        assert 0 <= hue <= 0.5
+
+        self.ranges = [
+            (max(0, 1 - brightness), 1 + brightness),
+            (max(0, 1 - contrast), 1 + contrast),
+            (max(0, 1 - saturation), 1 + saturation),
+            (-hue, hue)
+        ]
+
+    def sample_params(self, n, device=None, keys=None):
+        """
+        Draws the factors of the four adjustments and their order for a batch of n images.
+
+        Returns:
+            params - a dictionary with the factors, a float tensor of shape [n, 4], and the order, a LongTensor of shape [n, 4]
+        """
+        if keys is not None:
+            u = counter_uniform(as_keys(keys, device), 8, stream=7)
+        else:
+            u = torch.rand(n, 8, device=device)
+
+        low = torch.tensor([r[0] for r in self.ranges], device=u.device)
+        high = torch.tensor([r[1] for r in self.ranges], device=u.device)
+
+        return {'factors': low + (high - low) * u[:, :4], 'order': u[:, 4:].argsort(dim=1)}
+
+    def adjust(self, images, fn_id, factor):
+        factor = factor.view(-1, 1, 1, 1).to(images.dtype)
+        if fn_id == 0:
+            return (images * factor).clamp_(0, 1)
+        elif fn_id == 1:
+            mean = rgb_to_grayscale_batch(images).mean(dim=(-3, -2, -1), keepdim=True)
+            return (factor * images + (1 - factor) * mean).clamp_(0, 1)
+        elif fn_id == 2:
+            return (factor * images + (1 - factor) * rgb_to_grayscale_batch(images)).clamp_(0, 1)
+        else:
+            return adjust_hue_batch(images, factor.view(-1))
+
+    def __call__(self, image, key=None, params=None):
+        images = image.unsqueeze(0) if image.dim() == 3 else image
+        if params is None:
+            params = self.sample_params(images.shape[0], device=images.device, keys=key)
+        factors, order = params['factors'], params['order']
+
+        #the input is copied before the first in-place update of a subset
+        copied = False
+        for step in range(4):
+            for fn_id in range(4):
+                #adjustments with a range of (1, 1) or (0, 0) do nothing
+                if self.ranges[fn_id][0] == self.ranges[fn_id][1]:
+                    continue
+                idx = (order[:, step] == fn_id).nonzero().flatten()
+                if idx.numel() == images.shape[0]:
+                    images = self.adjust(images, fn_id, factors[:, fn_id])
+                    copied = True
+                elif idx.numel() > 0:
+                    if not copied:
+                        images = images.clone()
+                        copied = True
+                    images[idx] = self.adjust(images[idx], fn_id, factors[idx, fn_id])
+
+        return images[0] if image.dim() == 3 else images
+
+class MultiDistortion(object):
+    """
+    The random distortions of the 'multi' setting, for an image with dimension (C, H, W) in [0, 1] or a batch (N, C, H, W):
+    Random color jitter p=0.8 (max adjustment for: brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1),
+    Random Gaussian Blur p=0.1 (kernel 23x23, std uniformly random in [0.1, 2.0]),
+    Random Gaussian Noise p=0.2 (std uniformly random in [0.1, 0.3]),
+    Random Pixel Mask p=0.3 (percentage masked uniformly random in [0.5, 0.95]).
+
+    Instead of one RandomApply per distortion and per image, all the per-sample gates and strengths of a batch are drawn
+    up front (see sample_params), and each distortion is applied at once to the subset of the batch it was drawn for.
+    If a key (seed, sample_index, epoch) is given, or a batch of keys, all the distortions only depend on the key.
+    """
+    probs = {'jitter': 0.8, 'blur': 0.1, 'noise': 0.2, 'mask': 0.3}
+
+    def __init__(self):
+        self.jitter = ColorJitter(0.4, 0.4, 0.2, 0.1)
+        self.blur = GaussianBlur(kernel_size=23, sigma=[0.1, 2.0])
+        self.noise_std = [0.1, 0.3]
+        self.percent_missing = [0.5, 0.95]
+
+    def sample_params(self, n, h, w, device=None, keys=None):
+        """
+        Draws the per-sample gates (which distortions are applied) and strengths for a batch of n images of size (h, w).
+
+        Returns:
+            params - a dictionary of tensors with shape [n]
+        """
+        if keys is not None:
+            keys = as_keys(keys, device)
+            gates = counter_uniform(keys, 4, stream=4)
+            u = counter_uniform(keys, 3, stream=5)
+        else:
+            gates = torch.rand(n, 4, device=device)
+            u = torch.rand(n, 3, device=device)
+
+        params = {name: gates[:, i] < p for i, (name, p) in enumerate(MultiDistortion.probs.items())}
+        params['sigma'] = self.blur.sigma[0] + (self.blur.sigma[1] - self.blur.sigma[0]) * u[:, 0]
+        params['std'] = self.noise_std[0] + (self.noise_std[1] - self.noise_std[0]) * u[:, 1]
+        params['removed_num'] = (h * w * (self.percent_missing[0] + (self.percent_missing[1] - self.percent_missing[0]) * u[:, 2].double())).long()
+        jitter_params = self.jitter.sample_params(n, device=device, keys=keys)
+        params['jitter_factors'], params['jitter_order'] = jitter_params['factors'], jitter_params['order']
+        if keys is not None:
+            params['keys'] = keys
+
+        return params
+
+    def __call__(self, image, key=None, params=None):
+        images = (image.unsqueeze(0) if image.dim() == 3 else image).clone()
+        n, c, h, w = images.shape
+        if params is None:
+            params = self.sample_params(n, h, w, device=images.device, keys=key)
+        keys = params.get('keys')
+
+        idx = params['jitter'].nonzero().flatten()
+        if idx.numel() > 0:
+            jitter_params = {'factors': params['jitter_factors'][idx], 'order': params['jitter_order'][idx]}
+            images[idx] = self.jitter(images[idx], params=jitter_params)
+
+        idx = params['blur'].nonzero().flatten()
+        if idx.numel() > 0:
+            images[idx] = gaussian_blur_batch(images[idx], self.blur.kernel_size, params['sigma'][idx])
+
+        idx = params['noise'].nonzero().flatten()
+        if idx.numel() > 0:
+            if keys is not None:
+                noise = counter_normal(keys[idx], c * h * w, stream=6).view(-1, c, h, w).type_as(images)
+            else:
+                noise = torch.randn_like(images[idx])
+            images[idx] += noise * params['std'][idx].view(-1, 1, 1, 1).type_as(images)
+
+        idx = params['mask'].nonzero().flatten()
+        if idx.numel() > 0:
+            masks = random_mask_batch(params['removed_num'][idx], h, w, keys=keys[idx] if keys is not None else None)
+            images[idx] *= masks.unsqueeze(1).type_as(images)
+
+        return images[0] if image.dim() == 3 else images
+
+class DistortNormalize(object):
+    """
+    Fused version of ToTensor, a RandomMask/SquareMask/GaussianNoise distortion and Normalize, for contrastive pairs.
+    Takes a uint8 image with dimension (C, H, W) and returns the normalized clean and distorted images.
+    Both are computed in place in one [2, C, H, W] float tensor allocated per call, instead of separate float copies for
+    every step. The tensor is not reused between calls, since the DataLoader collates several returned samples at once.
+
+    Args:
+        distortion: the RandomMask, SquareMask or GaussianNoise distortion to apply
+        mean, std: the normalization constants
+    """
+    def __init__(self, distortion, mean, std):
+        assert isinstance(distortion, (RandomMask, SquareMask, GaussianNoise))
+
+        self.distortion = distortion
+        self.std = torch.tensor(std).view(-1, 1, 1)
+        self.mean_uint8 = 255*torch.tensor(mean).view(-1, 1, 1)
+        self.std_uint8 = 255*self.std
+
+    def __call__(self, x, key=None):
+        c, h, w = x.shape
+        out = torch.empty((2, c, h, w))
+        x_clean, x_noisy = out[0], out[1]
+
+        torch.sub(x, self.mean_uint8, out=x_clean)
+        x_clean.div_(self.std_uint8)
+
+        if isinstance(self.distortion, GaussianNoise):
+            #normalize(x + noise) = normalize(x) + noise/std
+            self.distortion.sample_noise(c, h, w, out=x_noisy, key=key)
+            x_noisy.div_(self.std).add_(x_clean)
+        else:
+            torch.mul(x, self.distortion.sample_mask(h, w, key), out=x_noisy)
+            x_noisy.sub_(self.mean_uint8).div_(self.std_uint8)
+
+        return x_clean, x_noisy
+
+class MaskBank(object):
+    """
+    A large bank of precomputed masks for RandomMask and SquareMask, bit-packed and stored in a .npy file.
+    The file is memory-mapped by every DataLoader worker, so drawing a mask is just a lookup and an unpack.
+
+    Masks are drawn with a counter that starts at a seeded offset in the bank, and is interleaved across DataLoader workers.
+    For a given seed and number of workers, the sequence of masks is the same between runs, without depending on the RNG state.
+    If a key (seed, sample_index, epoch) is given, the mask is instead picked by hashing the key, independently of the workers.
+
+    Args:
+        path: the .npy file of the bank, created by build
+        seed: the seed for the starting offset of the counter
+    """
+    def __init__(self, path, seed=0):
+        self.path = path
+        self.seed = seed
+        self.counter = 0
+        self.bits = None
+
+    def __getstate__(self):
+        #every worker opens its own memory map instead of receiving a copy of the bank
+        state = self.__dict__.copy()
+        state['bits'] = None
+        return state
+
+    def build(self, mask_fn, size, h, w):
+        """
+        Fills the bank with size masks of shape [h, w] drawn from mask_fn(h, w). Does nothing if the bank file already exists.
+        """
+        if os.path.exists(self.path):
+            return
+
+        print('Building mask bank ' + self.path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        #write to a temporary file of this process first, so that concurrent runs never read or overwrite a partial bank
+        tmp_path = '{}.{}.tmp.npy'.format(os.path.splitext(self.path)[0], os.getpid())
+        bits = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(size, h, (w + 7)//8))
+        for i in range(size):
+            bits[i] = np.packbits(mask_fn(h, w).numpy() > 0, axis=-1)
+        bits.flush()
+        del bits
+        os.replace(tmp_path, self.path)
+
+    def next_mask(self, h, w, key=None):
+        """
+        Returns the next mask of the bank, or the mask for the given key, as a float tensor of shape [h, w].
+        """
+        if self.bits is None:
+            self.bits = np.load(self.path, mmap_mode='r')
+            self.start = np.random.RandomState(self.seed).randint(self.bits.shape[0])
+        assert self.bits.shape[1:] == (h, (w + 7)//8)
+
+        if key is not None:
+            idx = int(_shr(counter_bits(as_keys(key), 1, stream=3), 1)) % self.bits.shape[0]
+        else:
+            worker_info = torch.utils.data.get_worker_info()
+            num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+
+            idx = (self.start + self.counter*num_workers + worker_id) % self.bits.shape[0]
+            self.counter += 1
+
+        return torch.from_numpy(np.unpackbits(self.bits[idx], axis=-1, count=w)).float()
+
+def use_mask_bank(distortion, args, h=224, w=224):
+    """
+    If args.mask_bank_dir is set, makes a RandomMask or SquareMask distortion draw its masks from a MaskBank.
+    Every set of distortion parameters gets its own bank file in args.mask_bank_dir, which is built the first time it is used.
+
+    Arguments:
+        distortion - the distortion to use the bank with. Other distortions, fixed masks and center squares are returned unchanged
+        args - the hyperparameters, with mask_bank_dir and optionally mask_bank_size (default 50000) and mask_bank_seed (default 0)
+        h, w - the size of the masks
+
+    Returns:
+        distortion - the same distortion, now drawing its masks from the bank
+    """
+    if not hasattr(args, 'mask_bank_dir') or args.mask_bank_dir is None:
+        return distortion
+    if not isinstance(distortion, (RandomMask, SquareMask)) or distortion.fixed:
+        return distortion
+    #the center square is the same for every image and already cached, a bank would only hold copies of it
+    if isinstance(distortion, SquareMask) and distortion.offset == "center":
+        return distortion
+
+    if isinstance(distortion, RandomMask):
+        percent = distortion.percent_missing
+        name = 'randommask_' + ('-'.join(str(p) for p in percent) if isinstance(percent, list) else str(percent))
+    else:
+        name = 'squaremask_{}_{}'.format(distortion.length, distortion.offset)
+
+    size = args.mask_bank_size if hasattr(args, 'mask_bank_size') else 50000
+    seed = args.mask_bank_seed if hasattr(args, 'mask_bank_seed') else 0
+
+    bank = MaskBank(os.path.join(args.mask_bank_dir, '{}_{}x{}_{}.npy'.format(name, h, w, size)), seed=seed)
+    bank.build(distortion.get_mask, size, h, w)
+    distortion.bank = bank
+
+    return distortion
+
+def apply_distortion(distortion, image, key=None):
+    """
+    Applies a distortion to an image, with the key (seed, sample_index, epoch) if given.
+    Torchvision distortions (e.g. transforms.GaussianBlur) do not take a key and are applied as usual.
+    """
+    if key is None or isinstance(distortion, torch.nn.Module):
+        return distortion(image)
+    return distortion(image, key=key)
+
+class KeyedDataset(Dataset):
+    """
+    Wraps a dataset so that its transform gets the key (seed, sample_index, epoch) of every sample.
+    With the distortions in this file, and the random crops of the training transforms (see keyed_crop), each sample then
+    only depends on its key and not on the order of the samples or the number of DataLoader workers.
+    Set the epoch attribute at the start of every epoch (see set_epoch). Has the same attributes as the wrapped dataset.
+
+    Args:
+        dataset: the dataset of (image, label) samples, without a transform
+        transform: the transform, called as transform(image, key=key)
+        seed: the seed of the keys
+        epoch: the current epoch
+    """
+    def __init__(self, dataset, transform, seed=0, epoch=0):
+        self.dataset = dataset
+        self.transform = transform
+        self.seed = seed
+        self.epoch = epoch
+
+        for attr in ['root', 'split', 'targets', 'wnids', 'wnid_to_idx', 'classes', 'class_to_idx', 'idx_to_class']:
+            if hasattr(dataset, attr):
+                setattr(self, attr, getattr(dataset, attr))
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, label = self.dataset[idx]
+
+        return self.transform(image, key=(self.seed, idx, self.epoch)), label
+
+def distortion_seed(args, transform):
+    """
+    Returns the seed of the keys (seed, sample_index, epoch) of the samples for a transform, args.distortion_seed, or None
+    if it is not set, if the images are not distorted or if there is no transform or it does not take a key.
+    """
+    if not hasattr(args, 'distortion_seed') or args.distortion_seed is None or args.distortion == "None":
+        return None
+    if transform is None or 'key' not in inspect.signature(transform).parameters:
+        return None
+    return args.distortion_seed
+
+def keyed_crop(x, key, uint8=False):
+    """
+    Takes the random resized crop to 224x224 and the random horizontal flip of the training transforms from the key
+    (seed, sample_index, epoch) instead of the global RNG. Returns the crop as a float tensor like ToTensor, or as uint8.
+    """
+    seed, idx, epoch = (int(k) for k in key)
+    x = ImageNetFixedCropTrain(seed=seed)(x, idx, epoch)
+    return x if uint8 else x.float().div(255)
+
+def set_epoch(dataloader, epoch):
+    """
+    Sets the epoch attribute of the datasets behind a training dataloader that have one (e.g. KeyedDataset, ImageNet100Tar
+    or ContrastiveUnsupervisedDataset), also through a Subset, so that their keys and shuffling change every epoch.
+    The dataloader can be a DataLoader, a list or dict of them, or the CombinedLoader that the Trainer makes of them,
+    whose loaders can be wrapped in CycleIterators and whose dataset attribute is a CombinedDataset.
+    It must be called before the DataLoader iterates, e.g. in on_train_epoch_start, since the workers get a copy of the dataset.
+    """
+    if isinstance(dataloader, dict):
+        for loader in dataloader.values():
+            set_epoch(loader, epoch)
+    elif isinstance(dataloader, (list, tuple)):
+        for loader in dataloader:
+            set_epoch(loader, epoch)
+    elif hasattr(dataloader, 'loaders'):
+        set_epoch(dataloader.loaders, epoch)
+    elif hasattr(dataloader, 'loader'):
+        set_epoch(dataloader.loader, epoch)
+    else:
+        dataset = getattr(dataloader, 'dataset', None)
+        #e.g. the few-shot subsets of the linear probe
+        while isinstance(dataset, Subset):
+            dataset = dataset.dataset
+        if hasattr(dataset, 'epoch'):
+            dataset.epoch = epoch
 
 class ImageNetBaseTransform:
     """
@@ -187,15 +937,21 @@ class ImageNetBaseTransformVal:
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
             )
 
-        self.transform = transforms.Compose([
+        self.transform_common = transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            normalize
+            transforms.ToTensor()
         ])
+        self.normalize = normalize
 
     def __call__(self, x):
-        return self.transform(x)
+        return self.normalize(self.transform_common(x))
+
+    def distort(self, x, key=None):
+        """
+        Applies the steps after ToTensor to a clean center crop, e.g. from CenterCropCache.
+        """
+        return self.normalize(x)
 
 class ImageNetBaseTrainContrastive:
     """
@@ -250,19 +1006,27 @@ class ImageNetDistortTrainContrastive:
         elif args.distortion == "gaussiannoise":
             distortion = GaussianNoise(std=convnoise(args.std,epoch), fixed=args.fixed_mask)
         elif args.distortion == "gaussianblur":
-            distortion = transforms.GaussianBlur(kernel_size=args.kernel_size, sigma=args.sigma)
-        self.distortion = distortion
+            distortion = GaussianBlur(kernel_size=args.kernel_size, sigma=args.sigma)
+        self.distortion = use_mask_bank(distortion, args)
+
+        #masks and noise are applied together with the normalization, straight from the uint8 image
+        self.fused = isinstance(self.distortion, (RandomMask, SquareMask, GaussianNoise))
+        if self.fused:
+            self.distort_normalize = DistortNormalize(self.distortion, normalize.mean, normalize.std)
 
         self.transform_common = transforms.Compose([
             transforms.RandomResizedCrop(224),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor()
+            transforms.PILToTensor() if self.fused else transforms.ToTensor()
         ])
 
-    def __call__(self, x):
-        x_temp = self.transform_common(x)
+    def __call__(self, x, key=None):
+        x_temp = self.transform_common(x) if key is None else keyed_crop(x, key, uint8=self.fused)
+        if self.fused:
+            return self.distort_normalize(x_temp, key)
+
         x_clean = self.normalize(x_temp)
-        x_noisy = self.normalize(self.distortion(x_temp))
+        x_noisy = self.normalize(apply_distortion(self.distortion, x_temp, key))
         return x_clean, x_noisy
 
 class ImageNetDistortValContrastive:
@@ -289,19 +1053,27 @@ class ImageNetDistortValContrastive:
         elif args.distortion == "gaussiannoise":
             distortion = GaussianNoise(std=args.std, fixed=args.fixed_mask)
         elif args.distortion == "gaussianblur":
-            distortion = transforms.GaussianBlur(kernel_size=args.kernel_size, sigma=args.sigma)
-        self.distortion = distortion
+            distortion = GaussianBlur(kernel_size=args.kernel_size, sigma=args.sigma)
+        self.distortion = use_mask_bank(distortion, args)
+
+        #masks and noise are applied together with the normalization, straight from the uint8 image
+        self.fused = isinstance(self.distortion, (RandomMask, SquareMask, GaussianNoise))
+        if self.fused:
+            self.distort_normalize = DistortNormalize(self.distortion, normalize.mean, normalize.std)
 
         self.transform_common = transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
-            transforms.ToTensor()
+            transforms.PILToTensor() if self.fused else transforms.ToTensor()
         ])
 
-    def __call__(self, x):
+    def __call__(self, x, key=None):
         x_temp = self.transform_common(x)
+        if self.fused:
+            return self.distort_normalize(x_temp, key)
+
         x_clean = self.normalize(x_temp)
-        x_noisy = self.normalize(self.distortion(x_temp))
+        x_noisy = self.normalize(apply_distortion(self.distortion, x_temp, key))
         return x_clean, x_noisy
 
 
@@ -328,19 +1100,20 @@ class ImageNetDistortTrain:
         elif args.distortion == "gaussiannoise":
             distortion = GaussianNoise(std=convnoise(args.std, epoch), fixed=args.fixed_mask)
         elif args.distortion == "gaussianblur":
-            distortion = transforms.GaussianBlur(kernel_size=args.kernel_size, sigma=args.sigma)
+            distortion = GaussianBlur(kernel_size=args.kernel_size, sigma=args.sigma)
+        distortion = use_mask_bank(distortion, args)
 
-        self.transform = transforms.Compose([
+        self.transform_common = transforms.Compose([
             transforms.RandomResizedCrop(224),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            distortion,
-            normalize
+            transforms.ToTensor()
         ])
+        self.normalize = normalize
         self.distortion = distortion
 
-    def __call__(self, x):
-        return self.transform(x)
+    def __call__(self, x, key=None):
+        x = self.transform_common(x) if key is None else keyed_crop(x, key)
+        return self.normalize(apply_distortion(self.distortion, x, key))
 
 class ImageNetDistortVal:
     """
@@ -367,26 +1140,33 @@ class ImageNetDistortVal:
         elif args.distortion == "gaussiannoise":
             distortion = GaussianNoise(std=convnoise(args.std, epoch), fixed=args.fixed_mask)
         elif args.distortion == "gaussianblur":
-            distortion = transforms.GaussianBlur(kernel_size=args.kernel_size, sigma=args.sigma)
+            distortion = GaussianBlur(kernel_size=args.kernel_size, sigma=args.sigma)
+        if fixed_distortion is None:
+            distortion = use_mask_bank(distortion, args)
 
-        self.transform = transforms.Compose([
+        self.transform_common = transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            distortion,
-            normalize
+            transforms.ToTensor()
         ])
+        self.normalize = normalize
         self.distortion = distortion
 
-    def __call__(self, x):
-        return self.transform(x)
+    def __call__(self, x, key=None):
+        return self.normalize(apply_distortion(self.distortion, self.transform_common(x), key))
+
+    def distort(self, x, key=None):
+        """
+        Applies the steps after ToTensor to a clean center crop, e.g. from CenterCropCache.
+        """
+        return self.normalize(apply_distortion(self.distortion, x, key))
 
 class ImageNetDistortTrainMulti:
     """
     Applies a series of transforms to an image:
     Random Crop to 224x224, Random horizontal clip p=0.5,
     Random color jitter p=0.8 (max adjustment for: brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1),
-    Random Gaussian Blur p=0.1 (kernel 23x23, std unformly random in [0.1, 0.2]),
+    Random Gaussian Blur p=0.1 (kernel 23x23, std uniformly random in [0.1, 2.0]),
     Random Gaussian Noise p=0.2 (std uniformly random in [0.1, 0.3]),
     Random Pixel Mask p=0.3 (percentage masked uniformly random in [0.5, 0.95]).
 
@@ -402,42 +1182,24 @@ class ImageNetDistortTrainMulti:
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
             )
 
-        randcrop = transforms.RandomResizedCrop(224)
-
-        randflip = transforms.RandomHorizontalFlip()
-
-        jitter = transforms.ColorJitter(0.4, 0.4, 0.2, 0.1)
-        randjitter = transforms.RandomApply([jitter], p=0.8)
-
-        blur = transforms.GaussianBlur(kernel_size=23)
-        randblur = transforms.RandomApply([blur], p=0.1)
-
-        noise = GaussianNoise(std=[0.1, 0.3], fixed=False)
-        randnoise = transforms.RandomApply([noise], p=0.2)
-
-        mask = RandomMask(percent_missing=[0.5, 0.95], fixed = False)
-        randmask = transforms.RandomApply([mask], p=0.3)
-
-        self.transform = transforms.Compose([
-            randcrop,
-            randflip,
-            randjitter,
-            transforms.ToTensor(),
-            randblur,
-            randnoise,
-            randmask,
-            normalize
+        self.transform_common = transforms.Compose([
+            transforms.RandomResizedCrop(224),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor()
         ])
+        self.normalize = normalize
+        self.distortion = MultiDistortion()
 
-    def __call__(self, x):
-        return self.transform(x)
+    def __call__(self, x, key=None):
+        x = self.transform_common(x) if key is None else keyed_crop(x, key)
+        return self.normalize(self.distortion(x, key))
 
 class ImageNetDistortValMulti:
     """
     Applies a series of transforms to an image:
     Resize to 256x256, Center crop to 224x224,
     Random color jitter p=0.8 (max adjustment for: brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1),
-    Random Gaussian Blur p=0.1 (kernel 23x23, std unformly random in [0.1, 0.2]),
+    Random Gaussian Blur p=0.1 (kernel 23x23, std uniformly random in [0.1, 2.0]),
     Random Gaussian Noise p=0.2 (std uniformly random in [0.1, 0.3]),
     Random Pixel Mask p=0.3 (percentage masked uniformly random in [0.5, 0.95]).
 
@@ -453,31 +1215,16 @@ class ImageNetDistortValMulti:
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
             )
 
-        jitter = transforms.ColorJitter(0.4, 0.4, 0.2, 0.1)
-        randjitter = transforms.RandomApply([jitter], p=0.8)
-
-        blur = transforms.GaussianBlur(kernel_size=23)
-        randblur = transforms.RandomApply([blur], p=0.1)
-
-        noise = GaussianNoise(std=[0.1, 0.3], fixed=False)
-        randnoise = transforms.RandomApply([noise], p=0.2)
-
-        mask = RandomMask(percent_missing=[0.5, 0.95], fixed = False)
-        randmask = transforms.RandomApply([mask], p=0.3)
-
-        self.transform = transforms.Compose([
+        self.transform_common = transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
-            randjitter,
-            transforms.ToTensor(),
-            randblur,
-            randnoise,
-            randmask,
-            normalize
+            transforms.ToTensor()
         ])
+        self.normalize = normalize
+        self.distortion = MultiDistortion()
 
-    def __call__(self, x):
-        return self.transform(x)
+    def __call__(self, x, key=None):
+        return self.normalize(self.distortion(self.transform_common(x), key))
 
 class ImageNetDistortTrainMultiContrastive:
     """
@@ -486,7 +1233,7 @@ class ImageNetDistortTrainMultiContrastive:
     Random distortions on the distorted copy are:
     Random Crop to 224x224, Random horizontal clip p=0.5,
     Random color jitter p=0.8 (max adjustment for: brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1),
-    Random Gaussian Blur p=0.1 (kernel 23x23, std unformly random in [0.1, 0.2]),
+    Random Gaussian Blur p=0.1 (kernel 23x23, std uniformly random in [0.1, 2.0]),
     Random Gaussian Noise p=0.2 (std uniformly random in [0.1, 0.3]),
     Random Pixel Mask p=0.3 (percentage masked uniformly random in [0.5, 0.95]).
 
@@ -502,45 +1249,18 @@ class ImageNetDistortTrainMultiContrastive:
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
             )
 
-        randcrop = transforms.RandomResizedCrop(224)
-
-        randflip = transforms.RandomHorizontalFlip()
-
-        jitter = transforms.ColorJitter(0.4, 0.4, 0.2, 0.1)
-        randjitter = transforms.RandomApply([jitter], p=0.8)
-
-        blur = transforms.GaussianBlur(kernel_size=23)
-        randblur = transforms.RandomApply([blur], p=0.1)
-
-        noise = GaussianNoise(std=[0.1, 0.3], fixed=False)
-        randnoise = transforms.RandomApply([noise], p=0.2)
-
-        mask = RandomMask(percent_missing=[0.5, 0.95], fixed = False)
-        randmask = transforms.RandomApply([mask], p=0.3)
-
         self.transform_common = transforms.Compose([
-            randcrop,
-            randflip
-        ])
-
-        self.transform_clean = transforms.Compose([
-            transforms.ToTensor(),
-            normalize
-        ])
-
-        self.transform_distort = transforms.Compose([
-            randjitter,
-            transforms.ToTensor(),
-            randblur,
-            randnoise,
-            randmask,
-            normalize
+            transforms.RandomResizedCrop(224),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor()
         ])
+        self.normalize = normalize
+        self.distortion = MultiDistortion()
 
-    def __call__(self, x):
-        x_temp = self.transform_common(x)
-        x_clean = self.transform_clean(x_temp)
-        x_noisy = self.transform_distort(x_temp)
+    def __call__(self, x, key=None):
+        x_temp = self.transform_common(x) if key is None else keyed_crop(x, key)
+        x_clean = self.normalize(x_temp)
+        x_noisy = self.normalize(self.distortion(x_temp, key))
 
         return x_clean, x_noisy
 
@@ -551,7 +1271,7 @@ class ImageNetDistortValMultiContrastive:
     Random distortions on the distorted copy are:
     Resize to 256x256, Center crop to 224x224,
     Random color jitter p=0.8 (max adjustment for: brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1),
-    Random Gaussian Blur p=0.1 (kernel 23x23, std unformly random in [0.1, 0.2]),
+    Random Gaussian Blur p=0.1 (kernel 23x23, std uniformly random in [0.1, 2.0]),
     Random Gaussian Noise p=0.2 (std uniformly random in [0.1, 0.3]),
     Random Pixel Mask p=0.3 (percentage masked uniformly random in [0.5, 0.95]).
 
@@ -567,49 +1287,436 @@ class ImageNetDistortValMultiContrastive:
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
             )
 
-        randcrop = transforms.RandomResizedCrop(224)
-
-        randflip = transforms.RandomHorizontalFlip()
+        self.transform_common = transforms.Compose([
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
+            transforms.ToTensor()
+        ])
+        self.normalize = normalize
+        self.distortion = MultiDistortion()
 
-        jitter = transforms.ColorJitter(0.4, 0.4, 0.2, 0.1)
-        randjitter = transforms.RandomApply([jitter], p=0.8)
+    def __call__(self, x, key=None):
+        x_temp = self.transform_common(x)
+        x_clean = self.normalize(x_temp)
+        x_noisy = self.normalize(self.distortion(x_temp, key))
 
-        blur = transforms.GaussianBlur(kernel_size=23)
-        randblur = transforms.RandomApply([blur], p=0.1)
+        return x_clean, x_noisy
 
-        noise = GaussianNoise(std=[0.1, 0.3], fixed=False)
-        randnoise = transforms.RandomApply([noise], p=0.2)
+class ImageNetCropTrain:
+    """
+    Torchvision composition of transforms that only crops ImageNet images, without distorting or normalizing them.
+    For training, this class will apply a random crop and random horizontal flip.
+    Used together with BatchDistortion, which distorts and normalizes the collated batch in the training step.
+    With args.uint8_transfer (or uint8=True), returns uint8 images, which are 4x smaller to send from the DataLoader workers.
+    """
+    def __init__(self, args, uint8=None):
+        if uint8 is None:
+            uint8 = hasattr(args, 'uint8_transfer') and args.uint8_transfer
+        self.transform = transforms.Compose([
+            transforms.RandomResizedCrop(224),
+            transforms.RandomHorizontalFlip(),
+            transforms.PILToTensor() if uint8 else transforms.ToTensor()
+        ])
 
-        mask = RandomMask(percent_missing=[0.5, 0.95], fixed = False)
-        randmask = transforms.RandomApply([mask], p=0.3)
+    def __call__(self, x):
+        return self.transform(x)
 
-        self.transform_common = transforms.Compose([
+class ImageNetCropVal:
+    """
+    Torchvision composition of transforms that only crops ImageNet images, without distorting or normalizing them.
+    For validation, this class will always crop from the center of the image and NOT apply a random horizontal flip.
+    Used together with BatchDistortion, which distorts and normalizes the collated batch.
+    With args.uint8_transfer (or uint8=True), returns uint8 images, which are 4x smaller to send from the DataLoader workers.
+    """
+    def __init__(self, args, uint8=None):
+        if uint8 is None:
+            uint8 = hasattr(args, 'uint8_transfer') and args.uint8_transfer
+        self.transform = transforms.Compose([
             transforms.Resize(256),
-            transforms.CenterCrop(224)
+            transforms.CenterCrop(224),
+            transforms.PILToTensor() if uint8 else transforms.ToTensor()
         ])
 
-        self.transform_clean = transforms.Compose([
-            transforms.ToTensor(),
-            normalize
-        ])
+    def __call__(self, x):
+        return self.transform(x)
 
-        self.transform_distort = transforms.Compose([
-            randjitter,
-            transforms.ToTensor(),
-            randblur,
-            randnoise,
-            randmask,
-            normalize
-        ])
+def fixed_crop_params(width, height, rng, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.)):
+    """
+    Draws the (top, left, height, width) of a random resized crop from a numpy Generator, as RandomResizedCrop.get_params
+    does with the torch generator.
+    """
+    area = height * width
+    log_ratio = np.log(ratio)
+    for _ in range(10):
+        target_area = area * rng.uniform(scale[0], scale[1])
+        aspect_ratio = np.exp(rng.uniform(log_ratio[0], log_ratio[1]))
+
+        w = int(round(np.sqrt(target_area * aspect_ratio)))
+        h = int(round(np.sqrt(target_area / aspect_ratio)))
+
+        if 0 < w <= width and 0 < h <= height:
+            i = int(rng.integers(0, height - h + 1))
+            j = int(rng.integers(0, width - w + 1))
+            return i, j, h, w
+
+    #fallback to a central crop
+    in_ratio = width / height
+    if in_ratio < min(ratio):
+        w = width
+        h = int(round(w / min(ratio)))
+    elif in_ratio > max(ratio):
+        h = height
+        w = int(round(h * max(ratio)))
+    else:
+        w = width
+        h = height
+    return (height - h) // 2, (width - w) // 2, h, w
 
-    def __call__(self, x):
-        x_temp = self.transform_common(x)
-        x_clean = self.transform_clean(x_temp)
-        x_noisy = self.transform_distort(x_temp)
+class ImageNetFixedCropTrain:
+    """
+    Crops ImageNet images with the k-th of a fixed set of random resized crops and horizontal flips of every image, drawn
+    from (seed, sample_index, k), and returns them as uint8 images without distorting or normalizing them.
+    Used to precompute the teacher embeddings of every augmentation (see precompute_teacher.py) and to make the same crops
+    for the student during training (see TeacherEmbeddingDataset).
+    """
+    def __init__(self, seed=0, size=224, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.)):
+        self.seed = seed
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+
+    def params(self):
+        """
+        Returns the parameters of the crops, as stored with the teacher embeddings by precompute_teacher.py.
+        """
+        return {'seed': self.seed, 'size': self.size, 'scale': list(self.scale), 'ratio': list(self.ratio)}
+
+    def __call__(self, x, idx, k):
+        rng = np.random.default_rng([self.seed, idx, k])
+        i, j, h, w = fixed_crop_params(x.size[0], x.size[1], rng, self.scale, self.ratio)
+        x = transforms.functional.resized_crop(x, i, j, h, w, (self.size, self.size))
+        if rng.random() < 0.5:
+            x = transforms.functional.hflip(x)
+        return transforms.functional.pil_to_tensor(x)
+
+def teacher_seed(args):
+    """
+    Returns the seed of the fixed augmentations of the teacher embeddings, args.teacher_seed or 0.
+    """
+    return args.teacher_seed if hasattr(args, 'teacher_seed') else 0
 
-        return x_clean, x_noisy
+def image_source(dataset):
+    """
+    Describes the images that an ImageNet100 dataset gives to its transform: the short side they are resized to beforehand
+    (None for the full resolution images of the folders) and a hash of the labels of the samples, in order.
+    Random crops of the same sample only match between datasets with the same source.
+    """
+    if isinstance(dataset, SharedCacheDataset):
+        short_side = dataset.resize.size
+    elif isinstance(dataset, ImageNet100Shards):
+        short_side = int(dataset.index[0, 2:].min())
+    else:
+        short_side = None
+
+    return {'short_side': short_side, 'num_samples': len(dataset),
+            'labels': hashlib.sha1(np.asarray(dataset.targets, dtype=np.int64).tobytes()).hexdigest()}
+
+def teacher_table_metadata(table):
+    """
+    Returns the path of the .json file with the crop parameters and image source of a table of teacher embeddings.
+    """
+    return os.path.splitext(table)[0] + '.json'
 
-class ImageNet100(ImageFolder):
+class TeacherEmbeddingDataset(Dataset):
+    """
+    Training samples with precomputed teacher embeddings: for every image, one of the K fixed augmentations of
+    ImageNetFixedCropTrain is picked at random, and the sample is the uint8 crop for the student along with the teacher
+    embedding of the same crop, read from the memory-mapped float16 table of shape [N, K, embedding_dim] made by
+    precompute_teacher.py. The crop parameters and the image source (see image_source) must match the ones stored
+    with the table, so the dataset should come from imagenet100_dataset with the same options as for the table.
+
+    Args:
+        dataset: the image dataset (e.g. ImageNet100), without a transform
+        table: the path to the .npy table of teacher embeddings
+        seed: the seed of the fixed augmentations
+        return_label: whether to also return the label
+    """
+    def __init__(self, dataset, table, seed=0, return_label=True):
+        self.dataset = dataset
+        self.table_path = table
+        self.crop = ImageNetFixedCropTrain(seed=seed)
+        self.return_label = return_label
+
+        self.table = None
+        num_images, self.num_augs, _ = np.load(table, mmap_mode='r').shape
+        if num_images != len(dataset):
+            raise ValueError('The teacher embeddings are for {} images, but the dataset has {}.'.format(num_images, len(dataset)))
+
+        if not os.path.exists(teacher_table_metadata(table)):
+            raise ValueError('No crop parameters found for the teacher embeddings in {}, run precompute_teacher.py again.'.format(table))
+        with open(teacher_table_metadata(table)) as f:
+            metadata = json.load(f)
+        if metadata['crop'] != self.crop.params():
+            raise ValueError('The teacher embeddings are for the crops {}, not {}.'.format(metadata['crop'], self.crop.params()))
+        if metadata['source'] != image_source(dataset):
+            raise ValueError('The teacher embeddings are for the images {}, but the dataset has {}.'.format(metadata['source'], image_source(dataset)))
+
+    def __getstate__(self):
+        #every worker opens its own memory map
+        state = self.__dict__.copy()
+        state['table'] = None
+        return state
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        if self.table is None:
+            self.table = np.load(self.table_path, mmap_mode='r')
+
+        image, label = self.dataset[idx]
+        k = random.randrange(self.num_augs)
+        image = self.crop(image, idx, k)
+        embedding = torch.from_numpy(np.array(self.table[idx, k]))
+
+        if self.return_label:
+            return image, embedding, label
+        return image, embedding
+
+class BatchDistortion(object):
+    """
+    Applies a distortion and then normalization to a whole collated batch of images with dimension (N, C, H, W).
+    Meant to be called in the training step after the batch has been transferred to the device, so that the
+    DataLoader workers only need to decode and crop the images (see ImageNetCropTrain).
+
+    Every image in the batch gets its own distortion parameters (e.g. its own mask or noise level).
+    These can be drawn with sample_params and passed explicitly, otherwise they are drawn on each call.
+    If a batch of keys (seed, sample_index, epoch) is given, the distortion of each image only depends on its key.
+    The images can be floats in [0, 1] or uint8 in [0, 255], in which case they are converted to floats here.
+
+    Args:
+        args: the hyperparameters, with the same distortion options as ImageNetDistortTrain
+        epoch: the current epoch, used for increasing noise levels
+    """
+    def __init__(self, args, epoch=None):
+        if args.encoder == "clip":
+            mean, std = [0.48145466, 0.4578275, 0.40821073], [0.26862954, 0.26130258, 0.27577711]
+        else:
+            mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+
+        if hasattr(args, 'fixed_mask') and args.fixed_mask:
+            raise ValueError('Fixed distortions are not supported when distorting whole batches.')
+
+        self.distortion = args.distortion
+        if args.distortion == "squaremask":
+            assert args.offset in ["center", "random"]
+            self.length = args.length
+            self.offset = args.offset
+        elif args.distortion == "randommask":
+            self.percent_missing = convnoise(args.percent_missing, epoch)
+        elif args.distortion == "gaussiannoise":
+            self.noise_std = convnoise(args.std, epoch)
+        elif args.distortion == "gaussianblur":
+            self.blur = GaussianBlur(kernel_size=args.kernel_size, sigma=args.sigma)
+        elif args.distortion == "multi":
+            self.multi = MultiDistortion()
+        elif args.distortion != "None":
+            raise ValueError('Batch distortion not implemented for ' + args.distortion)
+
+    def to_float(self, images):
+        """
+        Converts uint8 images in [0, 255] to float images in [0, 1]. Float images are returned unchanged.
+        """
+        if images.dtype == torch.uint8:
+            return images.float().div_(255)
+        return images
+
+    def normalize(self, images):
+        images = self.to_float(images)
+        return (images - self.mean.to(images)) / self.std.to(images)
+
+    def sample_params(self, n, h, w, device=None, keys=None):
+        """
+        Draws the per-sample parameters of the distortion for a batch of n images of size (h, w).
+        With an [n, 3] LongTensor of keys, the parameters are drawn with the counter-based generator and the keys are kept in
+        the parameters, to draw the masks and noise in distort.
+
+        Returns:
+            params - a dictionary of tensors with shape [n]
+        """
+        params = {} if keys is None else {'keys': as_keys(keys, device)}
+        keys = params.get('keys')
+
+        if self.distortion == "randommask":
+            params['removed_num'] = sample_removed_num(self.percent_missing, n, h, w, device=device, keys=keys)
+
+        elif self.distortion == "squaremask":
+            assert (self.length < h and self.length < w)
+            params['top'], params['left'] = sample_square_offsets(n, h, w, self.length, self.offset, device=device, keys=keys)
+
+        elif self.distortion == "gaussiannoise":
+            if isinstance(self.noise_std, list):
+                low, high = self.noise_std
+                u = counter_uniform(keys, 1, stream=0)[:, 0] if keys is not None else torch.rand(n, device=device)
+                params['std'] = low + (high - low) * u
+            else:
+                params['std'] = torch.full((n,), self.noise_std, device=device)
+
+        elif self.distortion == "gaussianblur":
+            sigma = self.blur.sample_sigma(n, keys, device=device)
+            params['sigma'] = sigma if torch.is_tensor(sigma) else torch.full((n,), sigma, device=device)
+
+        elif self.distortion == "multi":
+            params = self.multi.sample_params(n, h, w, device=device, keys=keys)
+
+        return params
+
+    def distort(self, images, params=None, keys=None):
+        """
+        Distorts a batch of un-normalized images with shape [N, C, H, W], using the given per-sample parameters.
+        """
+        images = self.to_float(images)
+        n, c, h, w = images.shape
+        if params is None:
+            params = self.sample_params(n, h, w, device=images.device, keys=keys)
+        keys = params.get('keys')
+
+        if self.distortion == "randommask":
+            return images * random_mask_batch(params['removed_num'], h, w, keys=keys).unsqueeze(1).type_as(images)
+
+        elif self.distortion == "squaremask":
+            masks = square_mask_batch(params['top'], params['left'], 2 * (self.length // 2), h, w)
+            return images * masks.unsqueeze(1).type_as(images)
+
+        elif self.distortion == "gaussiannoise":
+            if keys is not None:
+                noise = counter_normal(keys, c * h * w, stream=1).view_as(images).type_as(images)
+            else:
+                noise = torch.randn_like(images)
+            return images + noise * params['std'].view(n, 1, 1, 1).type_as(images)
+
+        elif self.distortion == "gaussianblur":
+            #a single sigma for the whole batch uses the cached kernel
+            sigma = params['sigma']
+            if not isinstance(self.blur.sigma, list):
+                sigma = self.blur.sigma
+            return gaussian_blur_batch(images, self.blur.kernel_size, sigma)
+
+        elif self.distortion == "multi":
+            return self.multi(images, params=params)
+
+        return images
+
+    def __call__(self, images, params=None, keys=None):
+        return self.normalize(self.distort(images, params, keys))
+
+    def paired_views(self, images, keys=None):
+        """
+        Makes the normalized (clean, noisy) pair of views of a batch of crops, as the contrastive transforms do per image.
+        Used with the compact samples of ContrastiveUnsupervisedDataset, which only carry the uint8 crop and its key.
+        """
+        images = self.to_float(images)
+        return self.normalize(images), self(images, keys=keys)
+
+def reduced_jpeg_loader(path, short_side=256):
+    """
+    Loads an image like the default ImageFolder loader, but JPEGs are decoded in the DCT domain at the smallest 1/2, 1/4
+    or 1/8 scale whose shorter side is still at least short_side, which saves decoding work before a Resize(short_side).
+    Only meant for the evaluation transforms, which start with Resize(256) and CenterCrop(224).
+    """
+    with open(path, 'rb') as f:
+        img = Image.open(f)
+        if img.format == 'JPEG':
+            w, h = img.size
+            scale = short_side / min(w, h)
+            #draft picks the largest reduction that keeps the image at least as large as the requested size
+            if scale < 0.5:
+                img.draft('RGB', (int(np.ceil(w * scale)), int(np.ceil(h * scale))))
+        return img.convert('RGB')
+
+def eval_image_loader(args):
+    """
+    Returns the image loader for the evaluation datasets: reduced_jpeg_loader if args.reduced_decode is set, else the default one.
+    """
+    if hasattr(args, 'reduced_decode') and args.reduced_decode:
+        return reduced_jpeg_loader
+    return default_loader
+
+#folder for the cached indices of the image folders, set the IMAGENET100_INDEX_CACHE environment variable to "" to disable it
+INDEX_CACHE_DIR = os.environ.get('IMAGENET100_INDEX_CACHE', os.path.expanduser('~/.cache/imagenet100_index'))
+
+def cached_folder_index(directory, meta_file, class_to_idx=None, extensions=IMG_EXTENSIONS):
+    """
+    Scans an ImageFolder-style directory and loads the {wnid: class names} dictionary of meta_file, with an on-disk cache.
+    The cache is keyed by the path, the mtimes of the directory, its class folders and meta_file, class_to_idx and the
+    extensions, so adding or removing images (which changes the mtime of their folder) makes a new scan.
+
+    Arguments:
+        directory - the folder with one subfolder of images per wnid
+        meta_file - the meta.bin file with the {wnid: class names} dictionary
+        class_to_idx - the {wnid: label} dictionary for the samples, by default the index of the wnid in the sorted wnids
+        extensions - the extensions of the images
+
+    Returns:
+        wnids - the sorted list of class folders, as ImageFolder.classes
+        samples - the list of (path, label) of the images, as ImageFolder.samples
+        wnid_to_classes - the {wnid: class names} dictionary for the wnids of the directory
+    """
+    directory = os.path.abspath(os.path.expanduser(directory))
+    wnid_dirs = sorted((entry for entry in os.scandir(directory) if entry.is_dir()), key=lambda entry: entry.name)
+    wnids = [entry.name for entry in wnid_dirs]
+    if class_to_idx is None:
+        class_to_idx = {wnid: idx for idx, wnid in enumerate(wnids)}
+
+    signature = repr((directory, os.stat(directory).st_mtime_ns, [(entry.name, entry.stat().st_mtime_ns) for entry in wnid_dirs],
+                      os.path.abspath(meta_file), os.stat(meta_file).st_mtime_ns, sorted(class_to_idx.items()), extensions))
+    cache_file = os.path.join(INDEX_CACHE_DIR, hashlib.sha1(signature.encode()).hexdigest() + '.pkl') if INDEX_CACHE_DIR else None
+
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+    samples = make_dataset(directory, class_to_idx, extensions=extensions)
+    wnid_to_classes = torch.load(meta_file)[0]
+    index = (wnids, samples, {wnid: wnid_to_classes[wnid] for wnid in wnids if wnid in wnid_to_classes})
+
+    #write to a temporary file first, so that concurrent runs never read a partial index
+    if cache_file is not None:
+        try:
+            os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(index, f)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+
+    return index
+
+class IndexedImageFolder(ImageFolder):
+    """
+    ImageFolder whose classes and samples come from cached_folder_index, so constructing the same dataset again does not
+    scan the folders. Also keeps the {wnid: class names} dictionary of meta_file as wnid_to_classes.
+    """
+    def __init__(self, root, meta_file, transform=None, target_transform=None, loader=default_loader):
+        VisionDataset.__init__(self, root, transform=transform, target_transform=target_transform)
+
+        wnids, samples, wnid_to_classes = cached_folder_index(root, meta_file)
+        self.loader = loader
+        self.extensions = IMG_EXTENSIONS
+        self.classes = wnids
+        self.class_to_idx = {wnid: idx for idx, wnid in enumerate(wnids)}
+        self.samples = samples
+        self.imgs = samples
+        self.targets = [s[1] for s in samples]
+        self.wnid_to_classes = wnid_to_classes
+
+class ImageNet100(IndexedImageFolder):
     """
     Dataset for ImageNet100. Majority of code taken from torchvision.datasets.ImageNet.
     Works in a similar function and has similar semantics to the original class.
@@ -624,7 +1731,7 @@ class ImageNet100(ImageFolder):
         META_FILE = "meta.bin"
 
         #initialize parameters from DatasetFolder
-        super(ImageNet100, self).__init__(os.path.join(root, split), **kwargs)
+        super(ImageNet100, self).__init__(os.path.join(root, split), os.path.join(root, META_FILE), **kwargs)
         self.root = root
         self.split = split
         self.transform = transform
@@ -633,8 +1740,8 @@ class ImageNet100(ImageFolder):
         #self.classes is a list of class names based on the folders present in our subset - actually wnids!
         #self.class_to_idx is a dict {wnid: wnid_index} where wnid_index is a number from 0 to 99
 
-        #Load the {wnid: class_name} dictionary from meta.bin
-        wnid_to_classes = torch.load(os.path.join(self.root, META_FILE))[0]
+        #The {wnid: class_name} dictionary from meta.bin
+        wnid_to_classes = self.wnid_to_classes
         self.wnids = self.classes #current self.classes is actually wnids!
         self.wnid_to_idx = self.class_to_idx
         self.classes = [wnid_to_classes[wnid] for wnid in self.wnids] #get the actual class names (e.g. "bird")
@@ -649,7 +1756,568 @@ class ImageNet100(ImageFolder):
                              for i, cls in enumerate(clss) if i == 0}
 
 
-class ImageNet100OOD(ImageFolder):
+class ImageNet100Shards(Dataset):
+    """
+    Dataset for ImageNet100 stored as pre-decoded images by shard_imagenet100.py, with the same attributes as ImageNet100.
+    The images are resized to a short side of 256 and stored as uint8 arrays in large shard files, which are memory-mapped
+    by every DataLoader worker, so getting a sample needs no JPEG decoding. Samples are returned as PIL images like ImageNet100.
+
+    Layout of root: meta.bin and, for every split, a folder with shard_XXXX.bin files, index.npy with one row
+    (shard, offset, height, width) per image, labels.npy and wnids.txt with the wnids in label order.
+    """
+    def __init__(self, root, split, transform=None):
+        #checking stuff
+        root = os.path.expanduser(root)
+        if split != 'train' and split != 'val':
+            raise ValueError('Split should be train or val.')
+
+        #contains our desired {wnid: class} dictionary
+        META_FILE = "meta.bin"
+
+        self.root = root
+        self.split = split
+        self.transform = transform
+
+        split_dir = os.path.join(root, split)
+        self.index = np.load(os.path.join(split_dir, 'index.npy'))
+        self.targets = np.load(os.path.join(split_dir, 'labels.npy')).tolist()
+        self.shard_paths = [os.path.join(split_dir, 'shard_{:04d}.bin'.format(i)) for i in range(int(self.index[:, 0].max()) + 1)]
+        self.shards = None
+
+        with open(os.path.join(split_dir, 'wnids.txt')) as f:
+            self.wnids = [x.strip() for x in f.readlines()]
+        self.wnid_to_idx = {wnid: idx for idx, wnid in enumerate(self.wnids)}
+
+        #same class names as ImageNet100, from the {wnid: class_name} dictionary in meta.bin
+        wnid_to_classes = torch.load(os.path.join(self.root, META_FILE))[0]
+        self.classes = [wnid_to_classes[wnid] for wnid in self.wnids]
+        self.class_to_idx = {cls: idx
+                             for idx, clss in enumerate(self.classes)
+                             for cls in clss}
+        self.idx_to_class = {idx: cls
+                             for idx, clss in enumerate(self.classes)
+                             for i, cls in enumerate(clss) if i == 0}
+
+    def __getstate__(self):
+        #every worker opens its own memory maps
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, idx):
+        if self.shards is None:
+            self.shards = [np.memmap(path, dtype=np.uint8, mode='r') for path in self.shard_paths]
+
+        shard, offset, h, w = self.index[idx]
+        image = Image.fromarray(np.asarray(self.shards[shard][offset:offset + h*w*3]).reshape(h, w, 3))
+        target = self.targets[idx]
+
+        if self.transform is not None:
+            image = self.transform(image)
+
+        return image, target
+
+#folder for the cached center crops of the evaluation datasets, can be set with the IMAGENET100_CROP_CACHE environment variable
+CROP_CACHE_DIR = os.environ.get('IMAGENET100_CROP_CACHE', os.path.expanduser('~/.cache/imagenet100_crops'))
+
+class CenterCropCache(Dataset):
+    """
+    The clean Resize(256) and CenterCrop(224) crops of an image folder dataset, decoded once and stored as a uint8 array
+    in a .npy file, which every later evaluation memory-maps instead of decoding the JPEGs again.
+    Samples are returned as float tensors in [0, 1] equal to the ToTensor output, so only the steps after ToTensor (the
+    distort method of the validation transforms) remain to be applied per pass.
+    The file is keyed by the samples and the loader of the dataset and the crop sizes, and takes 3 x size x size bytes per
+    image (about 750 MB for the 5000 validation images of ImageNet100), in CROP_CACHE_DIR unless cache_dir is given.
+
+    Args:
+        dataset: the image folder dataset (e.g. ImageNet100, ImageNet100OOD or ImageNet100C), its transform is ignored
+        transform: the transform of the float crops
+        resize: the size of the Resize
+        size: the size of the CenterCrop
+        workers: the number of DataLoader workers used to decode the images when building the file
+        cache_dir: the folder of the cached crops
+    """
+    def __init__(self, dataset, transform=None, resize=256, size=224, workers=0, cache_dir=CROP_CACHE_DIR):
+        self.transform = transform
+        self.targets = [s[1] for s in dataset.samples]
+
+        signature = repr(([(os.path.abspath(path), target) for path, target in dataset.samples],
+                          dataset.loader.__module__ + '.' + dataset.loader.__name__, resize, size))
+        self.path = os.path.join(cache_dir, hashlib.sha1(signature.encode()).hexdigest() + '.npy')
+        if not os.path.exists(self.path):
+            self.build(dataset, resize, size, workers)
+        self.crops = None
+
+    def build(self, dataset, resize, size, workers):
+        """
+        Decodes and crops every image of dataset into the .npy file.
+        """
+        dataset = copy.copy(dataset)
+        dataset.transform = transforms.Compose([
+            transforms.Resize(resize),
+            transforms.CenterCrop(size),
+            transforms.PILToTensor()
+        ])
+        dataset.target_transform = None
+
+        print('Building center crop cache {} ({:.2f} GB)'.format(self.path, len(dataset) * 3 * size**2 / 2**30))
+
+        #write to a temporary file first, so that concurrent runs never read a partial cache
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = '{}.{}.tmp.npy'.format(self.path[:-len('.npy')], os.getpid())
+        crops = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(dataset), 3, size, size))
+        start = 0
+        for images, _ in DataLoader(dataset, batch_size=64, num_workers=workers, shuffle=False):
+            crops[start:start + len(images)] = images.numpy()
+            start += len(images)
+        crops.flush()
+        del crops
+        os.replace(tmp_path, self.path)
+
+    def __getstate__(self):
+        #every worker opens its own memory map
+        state = self.__dict__.copy()
+        state['crops'] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, idx):
+        if self.crops is None:
+            self.crops = np.load(self.path, mmap_mode='r')
+
+        image = torch.from_numpy(np.array(self.crops[idx])).float().div(255)
+        target = self.targets[idx]
+
+        if self.transform is not None:
+            image = self.transform(image)
+
+        return image, target
+
+def eval_dataset(dataset, transform, args):
+    """
+    Attaches the validation transform to an evaluation dataset built without one.
+    If args.crop_cache is set, the clean center crops are read from a CenterCropCache and only transform.distort is applied,
+    otherwise if args.shared_cache_gb is set, the decoded images are kept in a SharedCacheDataset between the passes;
+    if args.distortion_seed is set, the dataset is wrapped in a KeyedDataset so that the distortions are reproducible.
+    """
+    if hasattr(args, 'crop_cache') and args.crop_cache:
+        dataset = CenterCropCache(dataset, workers=args.workers)
+        transform = transform.distort
+    elif shared_cache_budget(args):
+        dataset = SharedCacheDataset(dataset, shared_cache_budget(args))
+
+    #with a distortion seed, each image is distorted from its (seed, index) key, regardless of the workers
+    if distortion_seed(args, transform) is not None:
+        return KeyedDataset(dataset, transform, seed=distortion_seed(args, transform))
+
+    dataset.transform = transform
+    return dataset
+
+class ImageNet100Tar(IterableDataset):
+    """
+    Iterable dataset for ImageNet100 that streams the images of a split sequentially from one or more tar shards
+    (e.g. the archive made by slice_imagenet100.py), instead of opening every image file of the extracted folders.
+    Images are labeled by the wnid of their parent folder, with the same attributes as ImageNet100.
+
+    The shards are shuffled every epoch and split between the DataLoader workers (and processes, with distributed training),
+    and the samples go through a shuffle buffer. Set the epoch attribute at the start of every epoch to change the shuffling.
+    There must be at least as many shards as DataLoader workers (times processes), since every reader streams whole shards:
+    write class-mixed shards with write_tar_shards of slice_imagenet100.py, whose images are already shuffled over the
+    classes, or use 0 or 1 workers with a single archive.
+
+    The numbers of images of every split in the shards are read from the shards.json file next to them, written by
+    write_tar_shards. With it, every reader stops after the smallest number of images of the readers in the epoch,
+    so that all the processes of distributed training yield the same number of batches; it is required with more than
+    one process.
+
+    Args:
+        shards: a list of tar files, or a glob pattern for them
+        split: the folder of the split in the archive, train or val
+        wnids_file: the text file with the wnids of the classes (e.g. imagenet100.txt)
+        meta_file: the meta.bin file with the {wnid: class} dictionary
+        transform: the transform of the images
+        paired: whether the transform returns a pair of images (clean, noisy), as with ContrastiveUnsupervisedDataset
+        return_label: whether to return the label with a pair of images
+        shuffle_buffer: the number of samples to shuffle between, 0 to keep the order of the shards
+        length: the number of images in the split, if known (by default, the total of shards.json)
+        seed: the seed of the shuffling
+    """
+    IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+    def __init__(self, shards, split, wnids_file, meta_file, transform=None, paired=False, return_label=True,
+                 shuffle_buffer=5000, length=None, seed=0):
+        if split != 'train' and split != 'val':
+            raise ValueError('Split should be train or val.')
+
+        self.shards = sorted(glob.glob(os.path.expanduser(shards))) if isinstance(shards, str) else list(shards)
+        if len(self.shards) == 0:
+            raise ValueError('No tar shards found for ' + str(shards))
+        self.split = split
+        self.transform = transform
+        self.paired = paired
+        self.return_label = return_label
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+        counts_file = os.path.join(os.path.dirname(self.shards[0]), 'shards.json')
+        if os.path.exists(counts_file):
+            with open(counts_file) as f:
+                counts = json.load(f)[split]
+            self.counts = {path: counts[os.path.basename(path)] for path in self.shards}
+        else:
+            self.counts = None
+        self.length = length if length is not None or self.counts is None else sum(self.counts.values())
+
+        #same class indices as ImageFolder, which sorts the wnid folders
+        with open(wnids_file) as f:
+            self.wnids = sorted(x.strip() for x in f.readlines() if x.strip())
+        self.wnid_to_idx = {wnid: idx for idx, wnid in enumerate(self.wnids)}
+
+        wnid_to_classes = torch.load(meta_file)[0]
+        self.classes = [wnid_to_classes[wnid] for wnid in self.wnids]
+        self.class_to_idx = {cls: idx
+                             for idx, clss in enumerate(self.classes)
+                             for cls in clss}
+        self.idx_to_class = {idx: cls
+                             for idx, clss in enumerate(self.classes)
+                             for i, cls in enumerate(clss) if i == 0}
+
+    def __len__(self):
+        if self.length is None:
+            raise TypeError('The length of the tar shards is unknown.')
+        return self.length
+
+    def worker_split(self):
+        """
+        Returns the index and the number of the readers of the shards, over the DataLoader workers of all the processes.
+        """
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        else:
+            rank, world_size = 0, 1
+
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def read_shard(self, path):
+        """
+        Yields the (image bytes, label) of the split in a tar file, in order.
+        """
+        with tarfile.open(path, mode='r|*') as tar:
+            for member in tar:
+                parts = os.path.normpath(member.name).split(os.sep)
+                if not member.isfile() or len(parts) < 3 or parts[-3] != self.split or parts[-2] not in self.wnid_to_idx:
+                    continue
+                if not parts[-1].lower().endswith(ImageNet100Tar.IMG_EXTENSIONS):
+                    continue
+
+                yield tar.extractfile(member).read(), self.wnid_to_idx[parts[-2]]
+
+    def samples(self, rng):
+        reader_id, num_readers = self.worker_split()
+        if len(self.shards) < num_readers:
+            raise ValueError('{} tar shards for {} readers (DataLoader workers x processes): write at least as many shards '
+                             'with write_tar_shards of slice_imagenet100.py, or use fewer workers.'.format(
+                                 len(self.shards), num_readers))
+        if self.counts is None and torch.distributed.is_available() and \
+                torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1:
+            raise ValueError('Distributed training needs the shards.json file of write_tar_shards next to the tar shards, '
+                             'to give every process the same number of images.')
+
+        shards = list(self.shards)
+        rng.shuffle(shards)
+
+        samples = itertools.chain.from_iterable(self.read_shard(path) for path in shards[reader_id::num_readers])
+        if self.counts is None:
+            return samples
+
+        #the images of the shards beyond the smallest share are left out of this epoch
+        num_samples = min(sum(self.counts[path] for path in shards[i::num_readers]) for i in range(num_readers))
+        return itertools.islice(samples, num_samples)
+
+    def __iter__(self):
+        #the same order of the shards for every worker, so that they get disjoint shards
+        rng = random.Random(self.seed + self.epoch)
+        buffer_rng = random.Random((self.seed + self.epoch) * 1000003 + self.worker_split()[0])
+
+        buffer = []
+        for sample in self.samples(rng):
+            if self.shuffle_buffer == 0:
+                yield self.make_item(*sample)
+                continue
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = buffer_rng.randrange(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield self.make_item(*sample)
+
+        buffer_rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.make_item(*sample)
+
+    def make_item(self, data, label):
+        image = Image.open(io.BytesIO(data)).convert('RGB')
+
+        if not self.paired:
+            return (self.transform(image) if self.transform is not None else image), label
+
+        image_clean, image_noisy = self.transform(image) if self.transform is not None else (image, image)
+        if self.return_label:
+            return image_clean, image_noisy, label
+        else:
+            return image_clean, image_noisy
+
+def imagenet100_tar_dataset(args, split, transform=None, paired=False):
+    """
+    Returns an ImageNet100Tar dataset streaming a split from the tar shards matching args.tar_shards, or None if it is not set.
+    The wnids and meta.bin are read from args.dataset_dir, as for the subset file. Write the shards with TAR_SHARDS in
+    slice_imagenet100.py, with at least as many shards as DataLoader workers times GPUs.
+    """
+    if not hasattr(args, 'tar_shards') or not args.tar_shards:
+        return None
+
+    return ImageNet100Tar(
+        shards=args.tar_shards,
+        split=split,
+        wnids_file=os.path.join(args.dataset_dir, args.subset_file_name),
+        meta_file=os.path.join(args.dataset_dir, 'meta.bin'),
+        transform=transform,
+        paired=paired,
+        return_label=True,
+        shuffle_buffer=args.shuffle_buffer if hasattr(args, 'shuffle_buffer') else 5000,
+        seed=args.seed if hasattr(args, 'seed') else 0
+    )
+
+class SharedImagePool(object):
+    """
+    The shared memory of the SharedImageCaches of a process: a byte arena of budget bytes, in an unlinked file of
+    /dev/shm, that the decoded and resized uint8 images are written to one after the other, each one taking exactly its
+    h x w x 3 bytes. The arena is a ring buffer: when it is full, the next images are written over the oldest ones,
+    whatever their dataset, so all the caches of the process stay within one byte budget. The write position is kept in
+    a shared value behind a lock, and the file is sparse, so that its pages are only used as the images are written.
+    The arena is inherited by the DataLoader workers, so the pool must be created before the DataLoader iterates.
+
+    Args:
+        budget: the size of the arena in bytes
+        short_side: the short side of the cached images
+    """
+    def __init__(self, budget, short_side=256):
+        self.budget = int(budget)
+        self.short_side = short_side
+        #the first key of the next cache
+        self.num_keys = 0
+
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        free = shutil.disk_usage(shm_dir).free
+        if self.budget > free:
+            raise ValueError('The shared image cache budget of {:.1f} GB is larger than the {:.1f} GB free in {}.'.format(
+                self.budget / 2**30, free / 2**30, shm_dir))
+
+        fd, path = tempfile.mkstemp(prefix='imagenet100_cache_', dir=shm_dir)
+        os.unlink(path)
+        os.ftruncate(fd, self.budget)
+        self.fd = fd
+        #the number of bytes written since the start, the position of the next image is head % budget
+        self.head = multiprocessing.RawValue('q', 0)
+        self.lock = multiprocessing.Lock()
+        self.arena = None
+
+    @property
+    def nbytes(self):
+        return self.budget
+
+    def __getstate__(self):
+        #the mapping is made again from the file in every worker
+        state = self.__dict__.copy()
+        state['arena'] = None
+        return state
+
+    def data(self):
+        if self.arena is None:
+            self.arena = np.frombuffer(mmap.mmap(self.fd, self.budget), dtype=np.uint8)
+        return self.arena
+
+    def allocate_keys(self, num_keys):
+        """
+        Returns the first of num_keys new keys for the images of a cache.
+        """
+        first_key = self.num_keys
+        self.num_keys += num_keys
+        return first_key
+
+    def is_valid(self, pos):
+        """
+        Whether the image written at position pos of the arena has not been written over yet. Must hold the lock.
+        """
+        return pos >= 0 and pos >= self.head.value - self.budget
+
+    def write(self, image):
+        """
+        Writes a uint8 image after the last one, wrapping around to the start of the arena if it does not fit before
+        the end, and returns its position. Must hold the lock.
+        """
+        size = image.size
+        pos = self.head.value
+        if pos % self.budget + size > self.budget:
+            pos += self.budget - pos % self.budget
+        self.data()[pos % self.budget:pos % self.budget + size] = image.reshape(-1)
+        self.head.value = pos + size
+        return pos
+
+class SharedImageCache(object):
+    """
+    FIFO cache of the decoded and resized uint8 images of a dataset, used by all the DataLoader workers of a process.
+    The images are stored in the SharedImagePool of the process, and the position and size of the image of every sample
+    are kept in a shared array of the cache. An entry only counts while the pool has not written over its position, so
+    other caches can take the space of this one without touching its array.
+    Images larger than the whole pool are not cached.
+
+    Args:
+        pool: the SharedImagePool of the process
+        num_samples: the number of samples of the dataset
+    """
+    def __init__(self, pool, num_samples):
+        self.pool = pool
+        self.first_key = pool.allocate_keys(num_samples)
+        self.entries = multiprocessing.RawArray('q', [-1, 0, 0] * num_samples)
+        self.view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['view'] = None
+        return state
+
+    def table(self):
+        if self.view is None:
+            self.view = np.frombuffer(self.entries, dtype=np.int64).reshape(-1, 3)
+        return self.view
+
+    def get(self, idx):
+        """
+        Returns a copy of the cached image of sample idx as a (h, w, 3) uint8 array, or None if it is not cached.
+        """
+        table = self.table()
+        with self.pool.lock:
+            pos, h, w = table[idx]
+            if not self.pool.is_valid(pos):
+                return None
+            start = pos % self.pool.budget
+            return self.pool.data()[start:start + h * w * 3].reshape(h, w, 3).copy()
+
+    def put(self, idx, image):
+        """
+        Stores the (h, w, 3) uint8 image of sample idx after the last image of the pool, over the oldest ones.
+        """
+        h, w = image.shape[:2]
+        if image.size > self.pool.budget:
+            return
+
+        table = self.table()
+        with self.pool.lock:
+            if self.pool.is_valid(table[idx, 0]):
+                return
+            table[idx] = (self.pool.write(np.ascontiguousarray(image, dtype=np.uint8)), h, w)
+
+#the shared image pool of this process, and its caches by dataset, so that reloaded datasets and trainer.test() calls reuse them
+_SHARED_POOL = None
+_SHARED_CACHES = {}
+
+def shared_image_cache(dataset, budget, short_side=256):
+    """
+    Returns the SharedImageCache of this process for the samples of an image folder dataset, creating it if needed.
+    All the caches of the process share one SharedImagePool of budget bytes, created by the first call, and a dataset
+    with the same samples and loader (e.g. the training set reloaded every epoch) gets the same, already filled, cache.
+    """
+    global _SHARED_POOL
+    if _SHARED_POOL is None:
+        _SHARED_POOL = SharedImagePool(budget, short_side)
+    elif _SHARED_POOL.budget != budget or _SHARED_POOL.short_side != short_side:
+        raise ValueError('The shared image cache of this process already has a budget of {} bytes and a short side of {}.'.format(
+            _SHARED_POOL.budget, _SHARED_POOL.short_side))
+
+    signature = repr(([path for path, _ in dataset.samples], dataset.loader.__module__ + '.' + dataset.loader.__name__, short_side))
+    signature = hashlib.sha1(signature.encode()).hexdigest()
+    if signature not in _SHARED_CACHES:
+        _SHARED_CACHES[signature] = SharedImageCache(_SHARED_POOL, len(dataset.samples))
+    return _SHARED_CACHES[signature]
+
+class SharedCacheDataset(Dataset):
+    """
+    Wraps an image folder dataset (e.g. ImageNet100) so that its images are decoded and resized to a short side of
+    short_side once, and then read from a SharedImageCache of the process. Samples are returned as PIL images, with the
+    same attributes as the wrapped dataset.
+    The resize happens before the transform, so Resize(256) and CenterCrop(224) give the same images as without the
+    cache, while random crops are taken from the resized image instead of the full resolution one.
+
+    Args:
+        dataset: the image folder dataset, its transform is ignored
+        budget: the byte budget of the shared image pool of the process
+        transform: the transform of the images
+        short_side: the short side of the cached images
+    """
+    def __init__(self, dataset, budget, transform=None, short_side=256):
+        self.dataset = dataset
+        self.cache = shared_image_cache(dataset, budget, short_side)
+        self.transform = transform
+        self.resize = transforms.Resize(short_side)
+
+        for attr in ['root', 'split', 'targets', 'wnids', 'wnid_to_idx', 'classes', 'class_to_idx', 'idx_to_class']:
+            if hasattr(dataset, attr):
+                setattr(self, attr, getattr(dataset, attr))
+
+    def __len__(self):
+        return len(self.dataset.samples)
+
+    def __getitem__(self, idx):
+        path, target = self.dataset.samples[idx]
+
+        image = self.cache.get(idx)
+        if image is None:
+            image = np.asarray(self.resize(self.dataset.loader(path)), dtype=np.uint8)
+            self.cache.put(idx, image)
+        image = Image.fromarray(image)
+
+        if self.transform is not None:
+            image = self.transform(image)
+
+        return image, target
+
+def shared_cache_budget(args):
+    """
+    Returns the byte budget of the shared image pool of the process from args.shared_cache_gb, or 0 if it is not set.
+    """
+    if hasattr(args, 'shared_cache_gb') and args.shared_cache_gb:
+        return int(args.shared_cache_gb * 2**30)
+    return 0
+
+def imagenet100_dataset(args, split, transform=None):
+    """
+    Returns a split of ImageNet100: from the pre-decoded shards in args.shard_dir if it is set (see ImageNet100Shards),
+    otherwise from the image folders in args.dataset_dir, with reduced JPEG decoding for validation if args.reduced_decode is set
+    and through a SharedCacheDataset if args.shared_cache_gb is set.
+    If args.distortion_seed is set and the training transform takes a key, the training set is a KeyedDataset.
+    """
+    if split == 'train' and distortion_seed(args, transform) is not None:
+        return KeyedDataset(imagenet100_dataset(args, split), transform, seed=distortion_seed(args, transform))
+
+    if hasattr(args, 'shard_dir') and args.shard_dir:
+        return ImageNet100Shards(root=args.shard_dir, split=split, transform=transform)
+
+    #the validation images only need to be decoded at the scale of the center crop
+    loader = eval_image_loader(args) if split == 'val' else default_loader
+    if shared_cache_budget(args):
+        return SharedCacheDataset(ImageNet100(root=args.dataset_dir, split=split, loader=loader), shared_cache_budget(args), transform=transform)
+    return ImageNet100(root=args.dataset_dir, split=split, transform=transform, loader=loader)
+
+class ImageNet100OOD(IndexedImageFolder):
     """
     Dataset for ImageNet100. Majority of code taken from torchvision.datasets.ImageNet.
     Works in a similar function and has similar semantics to the original class.
@@ -664,7 +2332,7 @@ class ImageNet100OOD(ImageFolder):
         META_FILE = "meta.bin"
 
         #initialize parameters from DatasetFolder
-        super(ImageNet100OOD, self).__init__(os.path.join(root, split), **kwargs)
+        super(ImageNet100OOD, self).__init__(os.path.join(root, split), os.path.join(root, META_FILE), **kwargs)
         self.root = root
         self.split = split
         self.transform = transform
@@ -673,8 +2341,8 @@ class ImageNet100OOD(ImageFolder):
         #self.classes is a list of class names based on the folders present in our subset - actually wnids!
         #self.class_to_idx is a dict {wnid: wnid_index} where wnid_index is a number from 0 to 99
 
-        #Load the {wnid: class_name} dictionary from meta.bin
-        wnid_to_classes = torch.load(os.path.join(self.root, META_FILE))[0]
+        #The {wnid: class_name} dictionary from meta.bin
+        wnid_to_classes = self.wnid_to_classes
         self.wnids = self.classes #current self.classes is actually wnids!
         self.wnid_to_idx = self.class_to_idx
         self.classes = [wnid_to_classes[wnid] for wnid in self.wnids] #get the actual class names (e.g. "bird")
@@ -688,10 +2356,10 @@ class ImageNet100OOD(ImageFolder):
         for key in self.wnid_to_idx.keys():
             self.wnid_to_idx[key] = self.class_to_idx[wnid_to_classes[key]]
         print(self.wnid_to_idx)
-        self.samples = make_dataset(os.path.join(root, split), self.wnid_to_idx, extensions=('jpeg',))
+        self.samples = cached_folder_index(os.path.join(root, split), os.path.join(root, META_FILE), self.wnid_to_idx, extensions=('jpeg',))[1]
         self.targets = [s[1] for s in self.samples]
 
-class ImageNet100C(ImageFolder):
+class ImageNet100C(IndexedImageFolder):
     """
     Dataset for ImageNet100C. Majority of code taken from torchvision.datasets.ImageNet.
     Works in a similar function and has similar semantics to the original class.
@@ -708,7 +2376,7 @@ class ImageNet100C(ImageFolder):
         META_FILE = "meta.bin"
 
         #initialize parameters from DatasetFolder
-        super(ImageNet100C, self).__init__(data_root, **kwargs)
+        super(ImageNet100C, self).__init__(data_root, os.path.join(root, META_FILE), **kwargs)
         self.root = data_root
         self.split = split
         self.transform = transform
@@ -717,8 +2385,8 @@ class ImageNet100C(ImageFolder):
         #self.classes is a list of class names based on the folders present in our subset - actually wnids!
         #self.class_to_idx is a dict {wnid: wnid_index} where wnid_index is a number from 0 to 99
 
-        #Load the {wnid: class_name} dictionary from meta.bin
-        wnid_to_classes = torch.load(os.path.join(root, META_FILE))[0]
+        #The {wnid: class_name} dictionary from meta.bin
+        wnid_to_classes = self.wnid_to_classes
         self.wnids = self.classes #current self.classes is actually wnids!
         self.wnid_to_idx = self.class_to_idx
         self.classes = [wnid_to_classes[wnid] for wnid in self.wnids] #get the actual class names (e.g. "bird")
@@ -27,6 +27,10 @@ class NoisyCLIPTesting(LightningModule):
         self.test_top_1 = Accuracy(top_k=1)
         self.test_top_5 = Accuracy(top_k=5)
 
+    def on_test_start(self):
+        # Compute the text features of the backbone once, before the model is replicated.
+        self.backbone.text_embeddings()
+
     def forward(self, x):
         embed = self.backbone.encode_noisy_image(x)
         return self.backbone(embed)[0]